@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""AnalogAxis cost and direction changes over streams of raw samples.
+
+Streams recorded from a board can be given as files with one raw
+AnalogIn.value per line. Without arguments, generated streams are used:
+a stick at rest, slow pushes and flicks, all with ADC noise, and a stick
+held at the direction threshold.
+"""
+
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'board')
+)
+from analog import AnalogAxis  # NOQA: E402
+
+SAMPLE_COUNT = 100000
+NOISE = 600
+CENTER = 32768
+
+
+def generate_streams():
+    rng = random.Random(0)
+
+    def noisy(value):
+        return min(max(int(value + rng.gauss(0, NOISE)), 0), 65535)
+
+    return {
+        'rest': [noisy(CENTER) for _ in range(SAMPLE_COUNT)],
+        'slow push': [
+            noisy(CENTER + 32000 * math.sin(i / 5000))
+            for i in range(SAMPLE_COUNT)
+        ],
+        'flicks': [
+            noisy(CENTER + (32000 if i // 2000 % 4 == 1 else 0))
+            for i in range(SAMPLE_COUNT)
+        ],
+        'threshold': [
+            noisy(CENTER + 2048 + 16384) for _ in range(SAMPLE_COUNT)
+        ],
+    }
+
+
+def read_streams(paths):
+    streams = {}
+    for path in paths:
+        with open(path) as fp:
+            streams[os.path.basename(path)] = [
+                int(line) for line in fp if line.strip()
+            ]
+    return streams
+
+
+def run(samples):
+    axis = AnalogAxis()
+    changes = 0
+    direction = 0
+    start = time.perf_counter()
+    for raw in samples:
+        if axis.add_sample(raw) and axis.direction != direction:
+            direction = axis.direction
+            changes += 1
+    elapsed = time.perf_counter() - start
+    return elapsed / len(samples), changes
+
+
+def main():
+    paths = sys.argv[1:]
+    streams = read_streams(paths) if paths else generate_streams()
+    print(f'{"Stream":<16}{"Samples":>9}{"Per sample":>14}{"Changes":>9}')
+    for name, samples in streams.items():
+        per_sample, changes = run(samples)
+        print(
+            f'{name:<16}{len(samples):>9}{per_sample * 1e9:>11.0f} ns' +
+            f'{changes:>9}'
+        )
+
+
+if __name__ == '__main__':
+    main()
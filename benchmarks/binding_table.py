@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Size and decode time of the NVM binding table against bindings.json.
+
+bindings.json is what the board parsed at every boot before the table
+was stored in NVM. Times are host times without file system access, and
+json is implemented in C on both sides, so the sizes are what carries
+over to the board: reading the file from flash dominates there.
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'board')
+)
+import binding_store  # NOQA: E402
+
+COUNTS = (10, 32, 64, 128, 255)
+REPEAT = 200
+
+
+def make_bindings(count):
+    # A third of the buttons are tap/hold keys, like the tests
+    bindings = {}
+    for i in range(count):
+        if i % 3 == 0:
+            bindings[f'button_{i}'] = {
+                'tap': 0x04 + i % 26,
+                'hold': 0xE0 + i % 8,
+                'hold_time': 200,
+                'policy': 'hold',
+            }
+        else:
+            bindings[f'button_{i}'] = 0x04 + i % 26
+    return bindings
+
+
+def make_table(bindings):
+    table = bytearray()
+    for binding in bindings.values():
+        if isinstance(binding, dict):
+            table += bytes((
+                binding['tap'],
+                binding['hold'],
+                binding_store.pack_hold(binding['hold_time'], 1),
+            ))
+        else:
+            table += bytes((binding, 0, 0))
+    return table
+
+
+def load_json(text):
+    # What the board did with bindings.json at every boot
+    return make_table(json.loads(text))
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        function(*args)
+    return (time.perf_counter() - start) / REPEAT
+
+
+def main():
+    print(
+        f'{"Buttons":<9}{"JSON":>8}{"Table":>8}' +
+        f'{"From JSON":>14}{"decode_into":>14}{"encode":>12}'
+    )
+    for count in COUNTS:
+        bindings = make_bindings(count)
+        text = json.dumps(bindings, indent=4)
+        table = make_table(bindings)
+        data = binding_store.encode(table)
+        decoded = bytearray(len(table))
+        print(
+            f'{count:<9}{len(text):>8}{len(data):>8}' +
+            f'{timed(load_json, text) * 1e6:>11.1f} us' +
+            f'{timed(binding_store.decode_into, data, decoded) * 1e6:>11.1f}'
+            ' us' +
+            f'{timed(binding_store.encode, table) * 1e6:>9.1f} us'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Bytes written to the terminal per navigation step of map-keys.py -i.
+
+BindingWinManager runs in a child process on a pty of a fixed size. The
+parent counts the bytes that reach the master side between steps.
+"""
+
+import argparse
+import curses
+import fcntl
+import importlib.util
+import json
+import os
+import pty
+import struct
+import sys
+import termios
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+# pynput needs a display unless its dummy backend is used
+os.environ.setdefault('PYNPUT_BACKEND', 'dummy')
+
+from binding_tables import HID_KEY_CODES  # NOQA: E402
+
+ROWS = 40
+COLUMNS = 100
+BUTTON_COUNT = 500
+STEPS = 100
+PAGE_STEPS = 10
+# Written by the child after each step, curses never sends NUL bytes
+MARK = b'\0STEP\0'
+
+
+def load_map_keys():
+    spec = importlib.util.spec_from_file_location(
+        'map_keys', os.path.join(ROOT, 'map-keys.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.args = argparse.Namespace(dry_run=True, write_on_exit=True)
+    return module
+
+
+def run_steps():
+    # Child side: every step is followed by MARK on the terminal
+    map_keys = load_map_keys()
+    keycodes = list(HID_KEY_CODES.values())
+    bindings = {
+        f'button_{i}': keycodes[i % len(keycodes)]
+        for i in range(BUTTON_COUNT)
+    }
+    stdscr = curses.initscr()
+    curses.noecho()
+    curses.cbreak()
+    curses.curs_set(0)
+    stdscr.noutrefresh()
+    manager = map_keys.BindingWinManager((5, 2), bindings)
+
+    def step(action, *args):
+        action(*args)
+        os.write(sys.stdout.fileno(), MARK)
+
+    def repaint():
+        # What every step cost before rows were drawn incrementally
+        manager.win.redrawwin()
+        manager.redraw()
+
+    # Moves within the window, then moves that scroll it
+    step(lambda: None)
+    steps = [('move', manager.height - 1, manager.move_vertically, 'down')]
+    steps += [
+        ('scroll down', STEPS, manager.move_vertically, 'down'),
+        ('scroll up', STEPS, manager.move_vertically, 'up'),
+        ('page', PAGE_STEPS, manager.move_page, 'down'),
+        ('repaint', PAGE_STEPS, repaint),
+    ]
+    for name, count, action, *args in steps:
+        for _ in range(count):
+            step(action, *args)
+    curses.endwin()
+    return [(name, count) for name, count, *_ in steps]
+
+
+def main():
+    # The child sends the step names and counts through a pipe
+    read_fd, write_fd = os.pipe()
+    pid, fd = pty.fork()
+    if not pid:
+        fcntl.ioctl(
+            sys.stdin.fileno(), termios.TIOCSWINSZ,
+            struct.pack('HHHH', ROWS, COLUMNS, 0, 0)
+        )
+        os.environ['TERM'] = 'xterm-256color'
+        try:
+            steps = run_steps()
+            os.write(write_fd, json.dumps(steps).encode())
+        finally:
+            os._exit(0)
+
+    output = bytearray()
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError:  # EIO once the child exits
+            break
+        if not data:
+            break
+        output += data
+    os.waitpid(pid, 0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        steps = json.load(fp)
+
+    sizes = [len(chunk) for chunk in output.split(MARK)]
+    print(f'{ROWS}x{COLUMNS} terminal, {BUTTON_COUNT} buttons')
+    print(f'{"first draw":<12}{sizes[0]:>8} bytes')
+    start = 1
+    for name, count in steps:
+        group = sizes[start:start + count]
+        start += count
+        print(f'{name:<12}{sum(group) / count:>8.0f} bytes/step')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Firmware scan loop cost against the number of keys in a matrix.
+
+board/main.py runs on the fake CircuitPython modules of tests/, so the
+times are host times: compare rows with each other, not with the board.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+)
+import fake_circuitpython  # NOQA: E402
+
+MATRICES = ((2, 2), (4, 4), (4, 8), (8, 8), (8, 16), (15, 16))
+IDLE_PASSES = 20000
+
+
+def matrix_config(rows, columns):
+    layout = [
+        [f'r{row}c{column}' for column in range(columns)]
+        for row in range(rows)
+    ]
+    return {
+        'fast_boot': True,
+        'scan': 'matrix',
+        'rows': [f'GP{row}' for row in range(rows)],
+        'columns': [f'GP{rows + column}' for column in range(columns)],
+        'layout': layout,
+        'buttons': [btn for row in layout for btn in row],
+        'pins': {},
+        'analog': [],
+    }
+
+
+def run(rows, columns):
+    config = matrix_config(rows, columns)
+    # Every other key is a tap/hold key, tapped before its hold time
+    bindings = {
+        btn: (
+            0x04 + i % 26 if i % 2 else
+            {'tap': 0x04 + i % 26, 'hold': 0xE1, 'policy': 'permissive'}
+        )
+        for i, btn in enumerate(config['buttons'])
+    }
+    with tempfile.TemporaryDirectory() as directory, \
+            pytest.MonkeyPatch.context() as monkeypatch:
+        main = fake_circuitpython.boot_firmware(
+            monkeypatch, directory, config=config, bindings=bindings,
+            run_setup=False,
+        )
+        start = time.perf_counter()
+        main.setup()
+        setup_time = time.perf_counter() - start
+
+        clock = main.hw['supervisor'].clock
+        events = main.keys.events.queue
+        key_count = main.keys.key_count
+        for key_number in range(key_count):
+            events.append((key_number, True, clock.ticks_ms()))
+            events.append((key_number, False, clock.ticks_ms()))
+        start = time.perf_counter()
+        while events:
+            main.scan()
+        event_time = (time.perf_counter() - start) / (key_count * 2)
+
+        # Passes without events before the idle window starts
+        clock.ms += 10
+        start = time.perf_counter()
+        for _ in range(IDLE_PASSES):
+            main.scan()
+        idle_time = (time.perf_counter() - start) / IDLE_PASSES
+
+    return key_count, setup_time, event_time, idle_time
+
+
+def main():
+    print(f'{"Matrix":<8}{"Keys":>6}{"Setup":>12}{"Event":>12}{"Idle":>12}')
+    for rows, columns in MATRICES:
+        key_count, setup_time, event_time, idle_time = run(rows, columns)
+        print(
+            f'{f"{rows}x{columns}":<8}{key_count:>6}' +
+            f'{setup_time * 1e3:>9.2f} ms' +
+            f'{event_time * 1e6:>9.2f} us' +
+            f'{idle_time * 1e6:>9.2f} us'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,28 @@
-BUTTON_NAMES = {
-    1: 'select',
-    2: 'start',
-    3: 'cross',
-    4: 'up',
-    5: 'circle',
-    6: 'left',
-    7: 'right',
-    8: 'triangle',
-    9: 'down',
-    10: 'square',
-}
+import json
+import os
+
+BOARD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'board')
+BOARD_CONFIG_PATH = os.path.join(BOARD_DIR, 'config.json')
+
+BOARD_CONFIG = {}
+BUTTON_NAMES = {}
+
+
+def load_board_config(config_path):
+    # Updated in place, other modules import these by name
+    with open(config_path, 'r') as fp:
+        config = json.load(fp)
+    BOARD_CONFIG.clear()
+    BOARD_CONFIG.update(config)
+    BUTTON_NAMES.clear()
+    BUTTON_NAMES.update(
+        (button_n, button)
+        for button_n, button in enumerate(config['buttons'], 1)
+    )
+
+
+# The repository copy until map-keys.py finds the board's own
+load_board_config(BOARD_CONFIG_PATH)
 
 HID_KEY_CODES = {
     '1': 0x1E,
@@ -0,0 +1,70 @@
+# Integer-only filtering for analog sticks and triggers.
+# No CircuitPython imports so the math also runs on the host.
+
+AXIS_MAX = 32767
+
+
+class AnalogAxis:
+    def __init__(
+        self,
+        center=32768,
+        deadzone=2048,
+        oversample=8,
+        smoothing=2,
+        threshold=16384,
+        hysteresis=2048,
+    ):
+        self.center = center
+        self.deadzone = deadzone
+        self.oversample = oversample
+        # Exponential moving average weight, as a power of two:
+        # filtered += (average - filtered) >> smoothing
+        self.smoothing = smoothing
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.reset()
+
+    def reset(self):
+        self.sample_sum = 0
+        self.sample_count = 0
+        self.filtered = self.center
+        self.value = 0
+        self.direction = 0
+
+    def add_sample(self, raw):
+        # Returns True when a batch is complete and value was updated
+        self.sample_sum += raw
+        self.sample_count += 1
+        if self.sample_count < self.oversample:
+            return False
+
+        average = self.sample_sum // self.oversample
+        self.sample_sum = 0
+        self.sample_count = 0
+        self.filtered += (average - self.filtered) >> self.smoothing
+        self.value = self.scale(self.filtered - self.center)
+        self.direction = self.get_direction(self.value)
+        return True
+
+    def scale(self, offset):
+        # Symmetric, 0 up to the deadzone and AXIS_MAX at full travel
+        magnitude = offset if offset > 0 else -offset
+        if magnitude <= self.deadzone:
+            return 0
+        value = min(
+            (magnitude - self.deadzone) * AXIS_MAX //
+            (AXIS_MAX - self.deadzone),
+            AXIS_MAX,
+        )
+        return value if offset > 0 else -value
+
+    def get_direction(self, value):
+        if self.direction > 0 and value > self.threshold - self.hysteresis:
+            return 1
+        if self.direction < 0 and value < self.hysteresis - self.threshold:
+            return -1
+        if value >= self.threshold:
+            return 1
+        if value <= -self.threshold:
+            return -1
+        return 0
@@ -0,0 +1,106 @@
+# Binary binding table, stored in microcontroller.nvm.
+# No CircuitPython imports so map-keys.py can share the encoding.
+#
+# Layout: MAGIC (3 bytes), VERSION, button count, one entry per button
+# in the config "buttons" order, CRC-16 (little endian) of everything
+# before it.
+# Version 1 entries are a single keycode (0 when unbound). Version 2
+# entries are ENTRY_SIZE bytes: tap keycode, hold keycode (0 for plain
+# buttons) and the packed hold settings, see pack_hold().
+
+MAGIC = b'MPB'
+VERSION = 2
+HEADER_SIZE = 5
+ENTRY_SIZE = 3
+CRC_SIZE = 2
+
+HOLD_TIME_UNIT = 10  # ms
+HOLD_TIME_MAX = 0x3F * HOLD_TIME_UNIT
+DEFAULT_HOLD_TIME = 200
+
+
+def _crc16_nibble_table():
+    table = []
+    for nibble in range(16):
+        crc = nibble << 12
+        for _ in range(4):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+
+CRC_TABLE = _crc16_nibble_table()
+
+
+def crc16(data, end):
+    # CRC-16/CCITT-FALSE over data[:end], without slicing, a nibble at a
+    # time with a 16 entry table
+    crc = 0xFFFF
+    for i in range(end):
+        byte = data[i]
+        crc = ((crc << 4) & 0xFFFF) ^ CRC_TABLE[(crc >> 12) ^ (byte >> 4)]
+        crc = ((crc << 4) & 0xFFFF) ^ CRC_TABLE[(crc >> 12) ^ (byte & 0x0F)]
+    return crc
+
+
+def pack_hold(hold_time, policy):
+    # Policy in the top 2 bits, hold time in HOLD_TIME_UNIT in the rest
+    units = min(max(hold_time // HOLD_TIME_UNIT, 1), 0x3F)
+    return policy << 6 | units
+
+
+def unpack_hold(setting):
+    # Returns (hold time in ms, policy)
+    units = setting & 0x3F
+    hold_time = units * HOLD_TIME_UNIT if units else DEFAULT_HOLD_TIME
+    return hold_time, setting >> 6
+
+
+def encoded_size(count):
+    return HEADER_SIZE + count * ENTRY_SIZE + CRC_SIZE
+
+
+def encode(table):
+    # table holds ENTRY_SIZE bytes per button
+    count = len(table) // ENTRY_SIZE
+    end = HEADER_SIZE + len(table)
+    data = bytearray(encoded_size(count))
+    data[0:3] = MAGIC
+    data[3] = VERSION
+    data[4] = count
+    data[HEADER_SIZE:end] = table
+    crc = crc16(data, end)
+    data[end] = crc & 0xFF
+    data[end + 1] = crc >> 8
+    return bytes(data)
+
+
+def decode_into(data, table):
+    # Fills the preallocated table (ENTRY_SIZE bytes per button), version 1
+    # tables are read as buttons without hold keycodes
+    if len(data) < HEADER_SIZE or (
+        data[0] != MAGIC[0] or data[1] != MAGIC[1] or data[2] != MAGIC[2]
+    ):
+        raise ValueError('no binding table')
+    version = data[3]
+    if version == 1:
+        entry_size = 1
+    elif version == VERSION:
+        entry_size = ENTRY_SIZE
+    else:
+        raise ValueError('unsupported binding table version')
+    count = data[4]
+    end = HEADER_SIZE + count * entry_size
+    if count * ENTRY_SIZE != len(table) or len(data) < end + CRC_SIZE:
+        raise ValueError('binding table size mismatch')
+    if crc16(data, end) != data[end] | data[end + 1] << 8:
+        raise ValueError('binding table checksum mismatch')
+
+    for i in range(len(table)):
+        table[i] = 0
+    for i in range(count):
+        for j in range(entry_size):
+            table[i * ENTRY_SIZE + j] = data[HEADER_SIZE + i * entry_size + j]
@@ -3,6 +3,7 @@ import digitalio
 import usb_cdc
 import time
 import supervisor
+import json
 #  import storage
 
 
@@ -16,6 +17,15 @@ def blink(k, time_on=0.6, time_off=0.2, fast=False):
         time.sleep(time_off)
 
 
+def is_fast_boot():
+    # The boot blink is left to main.py when fast boot is enabled
+    try:
+        with open('config.json', 'r') as fp:
+            return json.load(fp).get('fast_boot', False)
+    except (OSError, ValueError):
+        return False
+
+
 def setup():
     global switch, led
     switch = digitalio.DigitalInOut(board.GP16)
@@ -26,7 +36,8 @@ def setup():
 
 
 def main():
-    blink(4, fast=True)
+    if not is_fast_boot():
+        blink(4, fast=True)
 
     usb_cdc.enable(console=True, data=True)
 
@@ -0,0 +1,56 @@
+# Command framing on the CDC data channel.
+# No CircuitPython imports so map-keys.py can share the protocol.
+#
+# Frame: FRAME_MAGIC, payload length, sequence number, payload.
+# Responses reuse the sequence number of the request and their payload
+# starts with ACK or NAK.
+
+FRAME_MAGIC = 0xA5
+FRAME_HEADER_SIZE = 3
+FRAME_MAX_PAYLOAD = 255
+FRAME_MAX_SIZE = FRAME_HEADER_SIZE + FRAME_MAX_PAYLOAD
+ACK = 0x06
+NAK = 0x15
+
+
+def encode_frame(seq, payload):
+    if len(payload) > FRAME_MAX_PAYLOAD:
+        raise ValueError(f'frame payload is too long ({len(payload)} bytes)')
+    return bytes((FRAME_MAGIC, len(payload), seq)) + payload
+
+
+def find_magic(buffer, start, end):
+    # Index of the next FRAME_MAGIC in buffer[start:end], or end
+    while start < end and buffer[start] != FRAME_MAGIC:
+        start += 1
+    return start
+
+
+def frame_end(buffer, start, end):
+    # End of the frame starting at buffer[start], or -1 while incomplete
+    if end - start < FRAME_HEADER_SIZE:
+        return -1
+    stop = start + FRAME_HEADER_SIZE + buffer[start + 1]
+    return stop if stop <= end else -1
+
+
+class FrameDecoder:
+    # Host side decoder, the firmware parses its receive buffer in place
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            start = find_magic(self.buffer, 0, len(self.buffer))
+            del self.buffer[:start]
+            end = frame_end(self.buffer, 0, len(self.buffer))
+            if end < 0:
+                break
+            frames.append((
+                self.buffer[2], bytes(self.buffer[FRAME_HEADER_SIZE:end])
+            ))
+            del self.buffer[:end]
+
+        return frames
@@ -6,90 +6,571 @@ import usb_hid
 import usb_cdc
 import json
 import os
+import keypad
+import gc
+import struct
+import supervisor
+import analogio
+import microcontroller
 
 # Adafruit
-from adafruit_hid.keyboard import Keyboard
+from adafruit_hid import find_device
 
+# App
+from analog import AnalogAxis, AXIS_MAX
+import binding_store
+from framing import (
+    ACK,
+    encode_frame,
+    find_magic,
+    frame_end,
+    FRAME_HEADER_SIZE,
+    FRAME_MAX_SIZE,
+    NAK,
+)
+from tap_hold import TapHold, NO_KEY, POLICY_NAMES
 
-def blink(k, time_on=0.5, time_off=0.2):
-    for _ in range(k):
-        led.value = True
-        time.sleep(time_on)
-        led.value = False
-        time.sleep(time_off)
+CONFIG_FILE_PATH = 'config.json'
+BINDINGS_FILE_PATH = 'bindings.json'
 
+# Size and mtime of bindings.json when it was last loaded, stored after
+# the largest binding table
+STAMP_OFFSET = binding_store.encoded_size(0xFF)
+STAMP_FORMAT = '<II'
+MODIFIER_KEYCODE = 0xE0
+TICKS_MASK = (1 << 29) - 1  # supervisor.ticks_ms() wraps at 2**29
+# supervisor.ticks_ms() at reset, 65 s before it wraps
+TICKS_AT_RESET = 0x1FFF0000
+LED_BLINK_MS = 100
+NO_BLINK = -1
+GC_IDLE_MS = 50
+GC_CHECK_MS = 100  # between gc.mem_free() and gc.mem_alloc() calls
+GC_MIN_FREE = 8 * 1024
+RX_CHUNK_SIZE = 64  # USB full speed packet
+MOUSE_INTERVAL_MS = 10
+MOUSE_AXES = ('x', 'y', 'wheel')  # index in mouse_report after buttons
+
+
+def blink():
+    # Turned off by scan() after LED_BLINK_MS
+    global led_on_since
+    led.value = True
+    led_on_since = supervisor.ticks_ms()
+
+
+def send_report():
+    global report_sent
+    try:
+        keyboard_device.send_report(report)
+    except OSError:
+        # The host has not finished enumerating the device yet
+        return False
+    if not report_sent:
+        report_sent = True
+        mark_phase('first_report')
+    return True
+
+
+def press_key(keycode):
+    if keycode >= MODIFIER_KEYCODE:
+        report[0] |= 1 << (keycode - MODIFIER_KEYCODE)
+    else:
+        for i in range(2, 8):
+            if report[i] == keycode:
+                return
+        for i in range(2, 8):
+            if not report[i]:
+                report[i] = keycode
+                break
+    send_report()
+
+
+def release_key(keycode):
+    if keycode >= MODIFIER_KEYCODE:
+        report[0] &= ~(1 << (keycode - MODIFIER_KEYCODE))
+    else:
+        for i in range(2, 8):
+            if report[i] == keycode:
+                report[i] = 0
+    send_report()
+
+
+def release_all_keys():
+    for i in range(8):
+        report[i] = 0
+    send_report()
+
+
+def collect_garbage(forced=False):
+    global gc_runs, gc_forced_runs, gc_worst_pause_us, gc_alloc_after
+    start = time.monotonic_ns()
+    gc.collect()
+    pause_us = (time.monotonic_ns() - start) // 1000
+    gc_alloc_after = gc.mem_alloc()
+    gc_runs += 1
+    if forced:
+        gc_forced_runs += 1
+    if pause_us > gc_worst_pause_us:
+        gc_worst_pause_us = pause_us
+
+
+def mark_phase(name):
+    boot_phases.append(
+        (name, (supervisor.ticks_ms() - TICKS_AT_RESET) & TICKS_MASK)
+    )
+
+
+def boot_times(args):
+    return '\n'.join(
+        f'{name} {ticks}'
+        for name, ticks in boot_phases
+    ).encode()
+
+
+def stats(args):
+    return struct.pack(
+        '<IIII', gc_runs, gc_forced_runs, gc_worst_pause_us, gc.mem_free()
+    )
 
-def reload_bindings():
-    global keyboard_pins
-    with open('bindings.json', 'r') as fp:
-        data = json.load(fp)
 
-    keyboard_pins = []
-    for btn, keycode in data.items():
-        if not keycode:
+def load_table():
+    # binding_table holds a binding_store entry per config button:
+    # tap keycode, hold keycode and packed hold settings
+    tap_hold.reset()
+    for key_number in range(len(keycode_per_key)):
+        keycode_per_key[key_number] = None
+    for i, btn in enumerate(BUTTONS):
+        if btn not in KEY_PER_BTN:
             continue
-        pin = GP_PIN_PER_BTN[btn]
-        keyboard_pins.append((pin, keycode))
+        key_number = KEY_PER_BTN[btn]
+        entry = i * binding_store.ENTRY_SIZE
+        keycode_per_key[key_number] = binding_table[entry] or None
+        if binding_table[entry + 1]:
+            hold_time, policy = binding_store.unpack_hold(
+                binding_table[entry + 2]
+            )
+            tap_hold.configure(
+                key_number, binding_table[entry + 1], hold_time, policy
+            )
+
+
+def store_table(data):
+    # Only touch the flash when the stored table differs
+    size = len(data)
+    for i in range(size):
+        if microcontroller.nvm[i] != data[i]:
+            microcontroller.nvm[0:size] = data
+            return
+
+
+def get_keycode(binding, btn):
+    if binding is None:
+        return 0
+    if not isinstance(binding, int) or not 0 <= binding <= 0xFF:
+        raise ValueError(f'invalid keycode for {btn}')
+    return binding
+
+
+def get_file_stamp():
+    stat = os.stat(BINDINGS_FILE_PATH)
+    return struct.pack(STAMP_FORMAT, stat[6], stat[8])
+
+
+def is_bindings_file_changed():
+    try:
+        stamp = get_file_stamp()
+    except OSError:
+        return False
+    return microcontroller.nvm[STAMP_OFFSET:STAMP_OFFSET + len(stamp)] != stamp
+
+
+def load_bindings_file():
+    # Raises ValueError for invalid files, binding_table is only replaced
+    # once every entry is valid
+    with open(BINDINGS_FILE_PATH, 'r') as fp:
+        data = json.load(fp)
+    if not isinstance(data, dict):
+        raise ValueError('bindings must be an object')
+    table = bytearray(len(binding_table))
+    for i, btn in enumerate(BUTTONS):
+        entry = i * binding_store.ENTRY_SIZE
+        binding = data.get(btn)
+        if isinstance(binding, dict):
+            hold_time = binding.get(
+                'hold_time', binding_store.DEFAULT_HOLD_TIME
+            )
+            policy = binding.get('policy', 'hold')
+            if not binding.get('hold'):
+                raise ValueError(f'no hold keycode for {btn}')
+            if not isinstance(hold_time, int) or not (
+                binding_store.HOLD_TIME_UNIT <= hold_time <=
+                binding_store.HOLD_TIME_MAX
+            ):
+                raise ValueError(f'invalid hold time for {btn}')
+            if policy not in POLICY_NAMES:
+                raise ValueError(f'invalid hold policy for {btn}')
+            table[entry] = get_keycode(binding.get('tap'), btn)
+            table[entry + 1] = get_keycode(binding['hold'], btn)
+            table[entry + 2] = binding_store.pack_hold(
+                hold_time, POLICY_NAMES.index(policy)
+            )
+        else:
+            table[entry] = get_keycode(binding, btn)
+    binding_table[:] = table
+    store_table(binding_store.encode(binding_table))
+    stamp = get_file_stamp()
+    end = STAMP_OFFSET + len(stamp)
+    if microcontroller.nvm[STAMP_OFFSET:end] != stamp:
+        microcontroller.nvm[STAMP_OFFSET:end] = stamp
+
+
+def load_stored_bindings():
+    # bindings.json is loaded when it changed since it was last loaded,
+    # otherwise the NVM table, which 'put' also writes, is used
+    if is_bindings_file_changed():
+        try:
+            load_bindings_file()
+            return
+        except ValueError as e:
+            print(BINDINGS_FILE_PATH, e)
+    try:
+        binding_store.decode_into(microcontroller.nvm, binding_table)
+    except ValueError as e:
+        print(e)
+
+
+def put_bindings(args):
+    binding_store.decode_into(args, binding_table)
+    store_table(args)
+    release_all_keys()
+    load_table()
+
+
+def set_bindings(args):
+    # Button index followed by its binding_store entry, per changed button
+    size = binding_store.ENTRY_SIZE + 1
+    if not args or len(args) % size:
+        raise ValueError('invalid binding entries')
+    for i in range(0, len(args), size):
+        if args[i] >= len(BUTTONS):
+            raise ValueError('invalid button index')
+    for i in range(0, len(args), size):
+        entry = args[i] * binding_store.ENTRY_SIZE
+        for j in range(binding_store.ENTRY_SIZE):
+            binding_table[entry + j] = args[i + 1 + j]
+    store_table(binding_store.encode(binding_table))
+    release_all_keys()
+    load_table()
+
+
+def get_bindings(args):
+    return binding_store.encode(binding_table)
+
+
+def setup_keys(config):
+    global keys, KEY_PER_BTN
+    interval = config.get('scan_interval', 0.02)
+    if config['scan'] == 'matrix':
+        # key_number = row * len(columns) + column
+        keys = keypad.KeyMatrix(
+            row_pins=[getattr(board, pin) for pin in config['rows']],
+            column_pins=[getattr(board, pin) for pin in config['columns']],
+            columns_to_anodes=config.get('columns_to_anodes', True),
+            interval=interval,
+        )
+        btn_per_key = [btn for row in config['layout'] for btn in row]
+    else:
+        btn_per_key = [
+            btn
+            for btn in config['buttons']
+            if btn in config['pins']
+        ]
+        keys = keypad.Keys(
+            [getattr(board, config['pins'][btn]) for btn in btn_per_key],
+            value_when_pressed=False,
+            pull=True,
+            interval=interval,
+        )
+
+    KEY_PER_BTN = {
+        btn: key_number
+        for key_number, btn in enumerate(btn_per_key)
+        if btn
+    }
+    return len(btn_per_key)
+
+
+def setup_analog(config, key_count):
+    # Axis direction buttons get key numbers after the scanned keys
+    global analog_channels, analog_axes, analog_keys, analog_directions
+    global analog_mouse, analog_index, mouse_device, mouse_report
+    global last_mouse_report
+    analog_channels = []
+    analog_axes = []
+    analog_keys = []
+    analog_mouse = []
+    for axis_config in config.get('analog', []):
+        analog_channels.append(
+            analogio.AnalogIn(getattr(board, axis_config['pin']))
+        )
+        analog_axes.append(AnalogAxis(
+            center=axis_config.get('center', 32768),
+            deadzone=axis_config.get('deadzone', 2048),
+            oversample=axis_config.get('oversample', 8),
+            smoothing=axis_config.get('smoothing', 2),
+            threshold=axis_config.get('threshold', 16384),
+            hysteresis=axis_config.get('hysteresis', 2048),
+        ))
+        axis_keys = []
+        for direction in ('low', 'high'):
+            btn = axis_config.get(direction)
+            if btn:
+                KEY_PER_BTN[btn] = key_count
+                axis_keys.append(key_count)
+                key_count += 1
+            else:
+                axis_keys.append(None)
+        analog_keys.append(tuple(axis_keys))
+        if 'mouse' in axis_config:
+            analog_mouse.append((
+                MOUSE_AXES.index(axis_config['mouse']) + 1,
+                axis_config.get('speed', 8),
+            ))
+        else:
+            analog_mouse.append(None)
+
+    analog_directions = [0] * len(analog_axes)
+    analog_index = 0
+    mouse_report = bytearray(4)
+    mouse_device = None
+    if any(analog_mouse):
+        mouse_device = find_device(
+            usb_hid.devices, usage_page=0x1, usage=0x02
+        )
+    last_mouse_report = supervisor.ticks_ms()
+    return key_count
+
+
+def set_analog_key(key_number, pressed):
+    # Direction buttons can be tap/hold keys like scanned ones
+    if key_number is not None:
+        tap_hold.key_event(key_number, pressed, supervisor.ticks_ms())
+
+
+def sample_analog():
+    # Takes one sample per call so the scan period is not stretched.
+    # Returns True when a direction button changed state.
+    global analog_index, last_mouse_report, pressed_count
+    i = analog_index
+    analog_index = (i + 1) % len(analog_axes)
+    axis = analog_axes[i]
+    if not axis.add_sample(analog_channels[i].value):
+        return False
+
+    mouse = analog_mouse[i]
+    if mouse:
+        # Scaled on the magnitude, floor division would drift negative
+        report_index, speed = mouse
+        value = axis.value
+        delta = (value if value > 0 else -value) * speed // AXIS_MAX
+        mouse_report[report_index] = (delta if value > 0 else -delta) & 0xFF
+        now = supervisor.ticks_ms()
+        if (now - last_mouse_report) & TICKS_MASK >= MOUSE_INTERVAL_MS:
+            last_mouse_report = now
+            if mouse_report[1] or mouse_report[2] or mouse_report[3]:
+                mouse_device.send_report(mouse_report)
+
+    direction = axis.direction
+    previous = analog_directions[i]
+    if direction == previous:
+        return False
+    # A held direction is not idle, even without a binding
+    low_key, high_key = analog_keys[i]
+    if previous:
+        pressed_count -= 1
+        set_analog_key(high_key if previous > 0 else low_key, False)
+    if direction:
+        pressed_count += 1
+        set_analog_key(high_key if direction > 0 else low_key, True)
+    analog_directions[i] = direction
+    return True
+
+
+def send_frame(seq, payload):
+    uart.write(encode_frame(seq, payload))
+
+
+def handle_command(seq, payload):
+    # Payload: command name, optionally followed by a space and arguments
+    name = bytes(payload)
+    args = b''
+    space = name.find(b' ')
+    if space >= 0:
+        name, args = name[:space], payload[space + 1:]
+    command = COMMANDS.get(name)
+    if not command:
+        send_frame(seq, bytes((NAK,)) + b'unknown command')
+        return
+    try:
+        response = command(args)
+    except (OSError, ValueError) as e:
+        send_frame(seq, bytes((NAK,)) + str(e).encode())
+        return
+    send_frame(seq, bytes((ACK,)) + (response or b''))
+
+
+def read_commands():
+    # Copied from a fixed chunk, slicing rx_view for readinto() allocates.
+    # Less than FRAME_MAX_SIZE bytes are left after parsing, so the chunk
+    # always fits.
+    global rx_len
+    count = uart.readinto(rx_chunk) or 0
+    for i in range(count):
+        rx_buffer[rx_len + i] = rx_chunk[i]
+    rx_len += count
+
+    start = find_magic(rx_buffer, 0, rx_len)
+    while start < rx_len:
+        end = frame_end(rx_buffer, start, rx_len)
+        if end < 0:
+            break
+        handle_command(
+            rx_buffer[start + 2], rx_view[start + FRAME_HEADER_SIZE:end]
+        )
+        start = find_magic(rx_buffer, end, rx_len)
+
+    for i in range(rx_len - start):
+        rx_buffer[i] = rx_buffer[start + i]
+    rx_len -= start
+
+
+def rebind(args):
+    load_bindings_file()
+    release_all_keys()
+    load_table()
+    blink()
 
 
 def setup():
-    global led, keyboard_pins, keyboard, uart, GP_PIN_PER_BTN
-    led = digitalio.DigitalInOut(board.LED)
-    led.direction = digitalio.Direction.OUTPUT
+    # Keys are scanned in the background as soon as keypad is set up, so
+    # everything that is not needed to send reports comes after it
+    global led, keycode_per_key, keyboard_device, report, event, uart
+    global BUTTONS, binding_table, tap_hold, FAST_BOOT, boot_phases
+    global rx_buffer, rx_view, rx_chunk, rx_len, led_on_since, COMMANDS
+    global report_sent
+    global gc_runs, gc_forced_runs, gc_worst_pause_us, gc_alloc_after
+    global pressed_count, last_activity, gc_checked
+    # Milliseconds since reset at each startup phase, read back with 'boot'
+    boot_phases = []
+    mark_phase('imports')
+
+    with open(CONFIG_FILE_PATH, 'r') as fp:
+        config = json.load(fp)
+    FAST_BOOT = config.get('fast_boot', False)
+    mark_phase('config')
+
+    keycode_per_key = [None] * setup_analog(config, setup_keys(config))
+    mark_phase('pins')
+
+    BUTTONS = config['buttons']
+    binding_table = bytearray(len(BUTTONS) * binding_store.ENTRY_SIZE)
+    tap_hold = TapHold(keycode_per_key, press_key, release_key)
+    load_stored_bindings()
+    load_table()
+    mark_phase('bindings')
+
+    # Reused HID report: modifiers, reserved, six keycodes
+    report = bytearray(8)
+    report_sent = False
+    event = keypad.Event()
+    keyboard_device = find_device(usb_hid.devices, usage_page=0x1, usage=0x06)
+    if not FAST_BOOT and not send_report():
+        time.sleep(1)
+    mark_phase('hid')
 
     uart = usb_cdc.data
     uart.timeout = 0
+    rx_buffer = bytearray(FRAME_MAX_SIZE + RX_CHUNK_SIZE)
+    rx_view = memoryview(rx_buffer)
+    rx_chunk = bytearray(RX_CHUNK_SIZE)
+    rx_len = 0
+    gc_runs = gc_forced_runs = gc_worst_pause_us = gc_alloc_after = 0
+    pressed_count = 0
+    last_activity = gc_checked = supervisor.ticks_ms()
 
-    keyboard = Keyboard(usb_hid.devices)
-
-    GP_PIN_PER_BTN = {
-        "select": board.GP0,
-        "cross": board.GP1,
-        "left": board.GP2,
-        "triangle": board.GP3,
-        "down": board.GP4,
-        "up": board.GP5,
-        "square": board.GP6,
-        "right": board.GP7,
-        "circle": board.GP8,
-        "start": board.GP9,
+    COMMANDS = {
+        b'rebind': rebind,
+        b'stats': stats,
+        b'get': get_bindings,
+        b'put': put_bindings,
+        b'set': set_bindings,
+        b'boot': boot_times,
     }
 
-    BINDINGS_FILE_PATH = 'bindings.json'
-    if BINDINGS_FILE_PATH in os.listdir():
-        with open(BINDINGS_FILE_PATH, 'r') as fp:
-            data = json.load(fp)
-    else:
-        data = {
-            button: None
-            for button in GP_PIN_PER_BTN.keys()
-        }
-
-    keyboard_pins = []
-    for btn, keycode in data.items():
-        pin = digitalio.DigitalInOut(GP_PIN_PER_BTN[btn])
-        pin.direction = digitalio.Direction.INPUT
-        pin.pull = digitalio.Pull.UP
-        GP_PIN_PER_BTN[btn] = pin
-        if not keycode:
-            continue
-        keyboard_pins.append((pin, keycode))
+    led = digitalio.DigitalInOut(board.LED)
+    led.direction = digitalio.Direction.OUTPUT
+    led_on_since = NO_BLINK
+    # In fast boot mode the boot blink is left to main.py
+    if FAST_BOOT:
+        blink()
+
+
+def is_idle():
+    return (
+        not pressed_count and
+        (supervisor.ticks_ms() - last_activity) & TICKS_MASK >= GC_IDLE_MS
+    )
+
+
+def scan():
+    # One pass of the main loop, it does not allocate so collections only
+    # happen while idle
+    global pressed_count, last_activity, gc_checked, led_on_since
+    if uart.in_waiting:
+        read_commands()
+        last_activity = supervisor.ticks_ms()
+
+    # While events are queued, key_event() decides on their timestamps
+    if tap_hold.pending_key != NO_KEY:
+        now = supervisor.ticks_ms()
+        if not keys.events:
+            tap_hold.tick(now)
+
+    if keys.events.get_into(event):
+        last_activity = supervisor.ticks_ms()
+        if event.pressed:
+            pressed_count += 1
+        elif pressed_count:
+            pressed_count -= 1
+        tap_hold.key_event(event.key_number, event.pressed, event.timestamp)
+
+    elif analog_axes and sample_analog():
+        last_activity = supervisor.ticks_ms()
+
+    elif (
+        led_on_since != NO_BLINK and
+        (supervisor.ticks_ms() - led_on_since) & TICKS_MASK >= LED_BLINK_MS
+    ):
+        led.value = False
+        led_on_since = NO_BLINK
+
+    elif (supervisor.ticks_ms() - gc_checked) & TICKS_MASK >= GC_CHECK_MS:
+        gc_checked = supervisor.ticks_ms()
+        if gc.mem_free() < GC_MIN_FREE:
+            collect_garbage(forced=True)
+        elif is_idle() and gc.mem_alloc() > gc_alloc_after:
+            collect_garbage()
 
 
 def main():
+    global last_activity
+    if not FAST_BOOT:
+        collect_garbage()
+    gc.disable()
+    last_activity = supervisor.ticks_ms()
+    mark_phase('scan')
     while True:
-        if uart.in_waiting:
-            data = uart.read(8)
-            uart.reset_input_buffer()
-            if data == b'rebind':
-                reload_bindings()
-                blink(1, 0.1, 0.1)
-
-        for pin, keycode in keyboard_pins:
-            if not pin.value:
-                keyboard.press(keycode)
-            else:
-                keyboard.release(keycode)
+        scan()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+# Tap/hold dual-function keys.
+# No CircuitPython imports so timed input traces can be replayed on the host.
+# Times are supervisor.ticks_ms() values (keypad.Event.timestamp uses the
+# same clock), which wrap at 2**29.
+
+from array import array
+
+TICKS_MASK = (1 << 29) - 1
+
+# What other keys do while a dual key is still undecided
+TAP_PREFERRED = 0  # pressing one selects tap, before it is sent
+HOLD_ON_OTHER_KEY = 1  # pressing one selects hold
+PERMISSIVE_HOLD = 2  # tapping one (press and release) selects hold
+POLICY_NAMES = ('tap', 'hold', 'permissive')
+
+IDLE = 0
+PENDING = 1
+HOLDING = 2
+TAPPING = 3
+
+NO_KEY = -1
+
+
+class TapHold:
+    def __init__(self, keycodes, press, release, buffer_size=16):
+        # keycodes is shared with the caller and holds the tap keycodes
+        key_count = len(keycodes)
+        self.keycodes = keycodes
+        self.press = press
+        self.release = release
+        self.hold_keycodes = bytearray(key_count)
+        self.hold_times = [0] * key_count
+        self.policies = bytearray(key_count)
+        self.states = bytearray(key_count)
+        # Events delayed by PERMISSIVE_HOLD, as key_number * 2 + pressed,
+        # 16 bits wide for matrices of 128 keys or more
+        self.buffer = array('H', bytes(2 * buffer_size))
+        self.buffer_len = 0
+        self.pending_key = NO_KEY
+        self.pending_since = 0
+
+    def configure(self, key_number, hold_keycode, hold_time, policy):
+        self.hold_keycodes[key_number] = hold_keycode or 0
+        self.hold_times[key_number] = hold_time
+        self.policies[key_number] = policy
+
+    def reset(self):
+        for key_number in range(len(self.states)):
+            self.states[key_number] = IDLE
+            self.hold_keycodes[key_number] = 0
+        self.buffer_len = 0
+        self.pending_key = NO_KEY
+
+    def tick(self, now):
+        if self.pending_key == NO_KEY:
+            return
+        elapsed = (now - self.pending_since) & TICKS_MASK
+        if elapsed >= self.hold_times[self.pending_key]:
+            self._resolve_hold(now)
+
+    def key_event(self, key_number, pressed, now):
+        self.tick(now)
+        pending_key = self.pending_key
+        if pending_key == NO_KEY:
+            self._process(key_number, pressed, now)
+            return
+
+        if key_number == pending_key:
+            self._resolve_tap(now)
+            return
+
+        policy = self.policies[pending_key]
+        if policy == HOLD_ON_OTHER_KEY:
+            if pressed:
+                self._resolve_hold(now)
+
+        elif policy == PERMISSIVE_HOLD:
+            if pressed or self._is_buffered(key_number):
+                if self.buffer_len == len(self.buffer):
+                    self._resolve_hold(now)
+                else:
+                    self.buffer[self.buffer_len] = key_number * 2 + pressed
+                    self.buffer_len += 1
+                    if not pressed:
+                        self._resolve_hold(now)
+                    return
+
+        elif pressed:
+            # TAP_PREFERRED: the tap is committed first so rolling onto
+            # another key keeps the typing order
+            self.states[pending_key] = TAPPING
+            self.pending_key = NO_KEY
+            if self.keycodes[pending_key]:
+                self.press(self.keycodes[pending_key])
+
+        self._process(key_number, pressed, now)
+
+    def _process(self, key_number, pressed, now):
+        hold_keycode = self.hold_keycodes[key_number]
+        keycode = self.keycodes[key_number]
+        if pressed:
+            if hold_keycode:
+                self.states[key_number] = PENDING
+                self.pending_key = key_number
+                self.pending_since = now
+            elif keycode:
+                self.press(keycode)
+            return
+
+        state = self.states[key_number]
+        self.states[key_number] = IDLE
+        if state == HOLDING:
+            self.release(hold_keycode)
+        elif state == TAPPING or (keycode and not hold_keycode):
+            if keycode:
+                self.release(keycode)
+
+    def _is_buffered(self, key_number):
+        entry = key_number * 2 + 1
+        for i in range(self.buffer_len):
+            if self.buffer[i] == entry:
+                return True
+        return False
+
+    def _resolve_tap(self, now):
+        key_number = self.pending_key
+        self.states[key_number] = IDLE
+        self.pending_key = NO_KEY
+        keycode = self.keycodes[key_number]
+        if keycode:
+            self.press(keycode)
+            self.release(keycode)
+        self._replay(now)
+
+    def _resolve_hold(self, now):
+        key_number = self.pending_key
+        self.states[key_number] = HOLDING
+        self.pending_key = NO_KEY
+        self.press(self.hold_keycodes[key_number])
+        self._replay(now)
+
+    def _replay(self, now):
+        # Buffered events go through key_event again in order, they may
+        # start or resolve another pending key
+        for _ in range(self.buffer_len):
+            if not self.buffer_len:
+                break
+            entry = self.buffer[0]
+            for i in range(1, self.buffer_len):
+                self.buffer[i - 1] = self.buffer[i]
+            self.buffer_len -= 1
+            self.key_event(entry >> 1, entry & 1, now)
@@ -4,24 +4,38 @@
 import argparse
 import json
 import curses
+import os
+import struct
 import time
 
 # Pynput
 from pynput.keyboard import Listener, Key
 
 # App
-from binding_tables import HID_KEY_CODES, BUTTON_NAMES
+from binding_tables import HID_KEY_CODES, BUTTON_NAMES, load_board_config
 from utils import (
+    binding_store,
     BoardException,
+    CommandChannel,
     CustomHelpFormatter,
+    decode_bindings,
+    diff_bindings,
+    encode_changes,
+    export_bindings,
     format_bindings,
     get_board_path,
     get_board_serial,
     get_bindings,
+    import_bindings,
+    make_hold_binding,
+    POLICY_NAMES,
     validate_button_type,
+    validate_file_type,
+    validate_hold_time_type,
     validate_path_type,
     validate_port_type,
     ValidateBindingAction,
+    watch_file,
 )
 
 
@@ -107,82 +121,173 @@ def custom_curses_wrapper(func, *args, **kwargs):
         curses.flushinp()
 
 
-class BindingWindow:
-    def __init__(self, pos, key_pos, button, key):
-        self.button = button
-        self.key = key
-        self.key_pos = key_pos
-        self.win = curses.newwin(1, curses.COLS - 4, *pos)
-        self.win.addstr(0, 1, button)
-        self.change_key(key)
-
-    def change_key(self, key, focus=False):
-        self.win.addstr(0, self.key_pos, key)
-        self.win.clrtoeol()
-        if focus:
-            self.focus()
-        self.win.refresh()
-
-    def focus(self):
-        self.win.chgat(0, 0, curses.A_REVERSE)
-        self.win.refresh()
-
-    def unfocus(self):
-        self.win.chgat(0, 0, curses.A_NORMAL)
-        self.win.refresh()
-
-
 class BindingWinManager:
     def __init__(self, start_pos, bindings):
-        self.current_pos = list(start_pos)
-        self.current_win_index = 0
         self.is_binding = False
-        self.prev_key = None
+        self.is_filtering = False
+        self.filter = ''
         self.bindings = bindings
         self.key_pos = len(max(bindings.keys(), key=len)) + 6
-
-        self.bind_wins = []
-        for button, key in format_bindings(bindings).items():
-            win = BindingWindow(
-                self.current_pos, self.key_pos, button, key
-            )
-            self.current_pos[0] += 1
-            self.bind_wins.append(win)
-
-        self.bind_wins[0].focus()
-
-    def _get_current_window(self):
-        new_win_index = self.current_win_index % len(self.bind_wins)
-        return self.bind_wins[new_win_index]
+        self.keys = format_bindings(bindings)
+        self.buttons = list(self.keys.keys())
+        self.visible = self.buttons
+        self.current_index = 0
+        self.top = 0
+
+        # Rows below the list are kept for the filter line
+        self.height = max(curses.LINES - start_pos[0] - 2, 1)
+        self.width = curses.COLS - start_pos[1] - 2
+        self.win = curses.newwin(self.height, self.width, *start_pos)
+        self.win.idlok(True)
+        self.win.scrollok(True)
+        self.status_win = curses.newwin(
+            1, self.width, start_pos[0] + self.height + 1, start_pos[1]
+        )
+        self.redraw()
+
+    def refresh(self):
+        self.win.noutrefresh()
+        self.status_win.noutrefresh()
+        curses.doupdate()
+
+    def _get_current_button(self):
+        return self.visible[self.current_index]
+
+    def _draw_row(self, index, key=None):
+        row = index - self.top
+        if not 0 <= row < self.height or index >= len(self.visible):
+            return
+        button = self.visible[index]
+        key = key or self.keys[button]
+        line = (' ' + button).ljust(self.key_pos) + key
+        # Writing the last cell of the window would move the cursor out
+        self.win.addnstr(row, 0, line, self.width - 1)
+        self.win.clrtoeol()
+        if index == self.current_index:
+            self.win.chgat(row, 0, curses.A_REVERSE)
+
+    def _draw_status(self):
+        self.status_win.erase()
+        if self.is_filtering or self.filter:
+            status = f'/{self.filter}'
+            if not self.visible:
+                status += '  (no matches)'
+            self.status_win.addnstr(0, 1, status, self.width - 2)
+
+    def redraw(self):
+        self.win.erase()
+        for index in range(self.top, self.top + self.height):
+            self._draw_row(index)
+        self._draw_status()
+        self.refresh()
 
     def enter_binding_mode(self):
-        bind_win = self._get_current_window()
-        bind_win.change_key('<Press any key>', focus=True)
+        if not self.visible:
+            return
+        self._draw_row(self.current_index, '<Press any key>')
+        self.refresh()
         self.is_binding = True
 
     def exit_binding_mode(self):
-        bind_win = self._get_current_window()
-        bind_win.change_key(bind_win.key, focus=True)
+        self._draw_row(self.current_index)
+        self.refresh()
         self.is_binding = False
 
     def rebind(self, key):
         self.is_binding = False
-        bind_win = self._get_current_window()
-        bind_win.key = key
-        self.bindings[bind_win.button] = HID_KEY_CODES[key]
+        button = self._get_current_button()
+        self.keys[button] = format_bindings({button: HID_KEY_CODES[key]})[
+            button
+        ]
+        self.bindings[button] = HID_KEY_CODES[key]
         if not args.dry_run and not args.write_on_exit:
-            write_bindings(self.bindings)
-            if args.reload:
-                reload_bindings()
-        bind_win.change_key(key, focus=True)
+            sync_bindings(self.bindings)
+        self._draw_row(self.current_index)
+        self.refresh()
+
+    def move_to(self, index):
+        if not self.visible:
+            return
+        prev_index = self.current_index
+        self.current_index = index % len(self.visible)
+        offset = 0
+        if self.current_index < self.top:
+            offset = self.current_index - self.top
+        elif self.current_index >= self.top + self.height:
+            offset = self.current_index - self.top - self.height + 1
+
+        if abs(offset) >= self.height:
+            self.top += offset
+            self.redraw()
+            return
+
+        if offset:
+            self.win.scroll(offset)
+            self.top += offset
+            new_rows = range(
+                *(
+                    (self.top + self.height - offset, self.top + self.height)
+                    if offset > 0
+                    else (self.top, self.top - offset)
+                )
+            )
+            for index in new_rows:
+                self._draw_row(index)
+        self._draw_row(prev_index)
+        self._draw_row(self.current_index)
+        self.refresh()
 
-    def move_vertically(self, direction):
-        self._get_current_window().unfocus()
+    def move_vertically(self, direction, step=1):
         if direction == 'up':
-            self.current_win_index -= 1
+            self.move_to(self.current_index - step)
         elif direction == 'down':
-            self.current_win_index += 1
-        self._get_current_window().focus()
+            self.move_to(self.current_index + step)
+
+    def move_page(self, direction):
+        if not self.visible:
+            return
+        if direction == 'up':
+            index = max(self.current_index - self.height, 0)
+        else:
+            index = min(
+                self.current_index + self.height, len(self.visible) - 1
+            )
+        self.move_to(index)
+
+    def start_filter(self):
+        self.is_filtering = True
+        self._draw_status()
+        self.refresh()
+
+    def stop_filter(self, clear=False):
+        self.is_filtering = False
+        if clear:
+            self.set_filter('')
+        else:
+            self._draw_status()
+            self.refresh()
+
+    def set_filter(self, text):
+        current_button = None
+        if self.visible:
+            current_button = self._get_current_button()
+        self.filter = text
+        text = text.lower().replace(' ', '_')
+        self.visible = [
+            button
+            for button in self.buttons
+            if text in button or text in self.keys[button].replace(' ', '_')
+        ]
+        if current_button in self.visible:
+            self.current_index = self.visible.index(current_button)
+        else:
+            self.current_index = 0
+        self.top = min(self.top, max(len(self.visible) - self.height, 0))
+        self.top = min(
+            max(self.top, self.current_index - self.height + 1),
+            self.current_index
+        )
+        self.redraw()
 
 
 def run_interactive_mode(stdscr, bindings):
@@ -191,13 +296,15 @@ def run_interactive_mode(stdscr, bindings):
     stdscr = curses.initscr()
     curses.curs_set(0)
 
-    top_msg = 'Use arrow keys to navigate, press Enter to bind.'
+    top_msg = (
+        'Use arrow keys to navigate, press Enter to bind and / to filter.'
+    )
     largest_btn = len(max(bindings, key=len))
 
     stdscr.addstr(1, 2, top_msg)
     stdscr.addstr(3, 3, 'Buttons', curses.A_BOLD)
     stdscr.addstr(3, 8 + largest_btn, 'Keys', curses.A_BOLD)
-    stdscr.refresh()
+    stdscr.noutrefresh()
 
     binding_win_manager = BindingWinManager((5, 2), bindings)
 
@@ -227,9 +334,28 @@ def run_interactive_mode(stdscr, bindings):
                     continue
             binding_win_manager.rebind(pressed_key)
 
+        elif binding_win_manager.is_filtering:
+            text = binding_win_manager.filter
+            if pressed_key == 'enter':
+                binding_win_manager.stop_filter()
+            elif pressed_key == 'esc':
+                binding_win_manager.stop_filter(clear=True)
+            elif pressed_key == 'backspace':
+                binding_win_manager.set_filter(text[:-1])
+            elif pressed_key == 'space':
+                binding_win_manager.set_filter(text + ' ')
+            elif len(pressed_key) == 1:
+                binding_win_manager.set_filter(text + pressed_key)
+
         elif pressed_key in ('enter', 'space', 'r'):
             binding_win_manager.enter_binding_mode()
 
+        elif pressed_key == '/':
+            binding_win_manager.start_filter()
+
+        elif pressed_key == 'esc' and binding_win_manager.filter:
+            binding_win_manager.set_filter('')
+
         elif pressed_key in ('esc', 'q'):
             break
 
@@ -239,35 +365,172 @@ def run_interactive_mode(stdscr, bindings):
         elif pressed_key in ('down', 'j'):
             binding_win_manager.move_vertically('down')
 
+        elif pressed_key == 'page_up':
+            binding_win_manager.move_page('up')
 
-def write_bindings(bindings):
-    with open(config_file_path, 'w') as fp:
-        json.dump(bindings, fp, indent=4)
+        elif pressed_key == 'page_down':
+            binding_win_manager.move_page('down')
 
+        elif pressed_key == 'home':
+            binding_win_manager.move_to(0)
 
-def reload_bindings():
-    global board_serial
+        elif pressed_key == 'end':
+            binding_win_manager.move_to(-1)
+
+
+def read_bindings():
+    if args.json:
+        return get_bindings(config_file_path)
+    data, rtt = get_board_channel().request(b'get')
+    if args.verbose:
+        print(f'Board sent bindings in {rtt * 1000:.1f} ms')
+    return decode_bindings(data)
+
+
+def write_bindings(bindings):
+    global board_bindings
+    if args.json:
+        with open(config_file_path, 'w') as fp:
+            json.dump(bindings, fp, indent=4)
+    else:
+        # Only changed buttons are sent, the board stores and applies each
+        # frame of them at once
+        channel = get_board_channel()
+        responses = channel.wait([
+            channel.send(b'set ', data)
+            for data in encode_changes(diff_bindings(board_bindings, bindings))
+        ])
+        if args.verbose and not args.interactive:
+            rtt = max(rtt for _, rtt in responses.values())
+            print(f'Board stored bindings in {rtt * 1000:.1f} ms')
+    board_bindings = bindings.copy()
+
+
+def sync_bindings(bindings):
+    changes = diff_bindings(board_bindings, bindings)
+    if not changes:
+        return changes
+    write_bindings(bindings)
+    if args.json and args.reload:
+        reload_bindings()
+    return changes
+
+
+def get_board_channel():
+    global board_serial, board_channel
     if not board_serial or board_serial.closed:
         board_serial = get_board_serial(args.port)
-    board_serial.write(b'rebind')
+        board_channel = CommandChannel(board_serial)
+    return board_channel
+
+
+def reload_bindings():
+    _, rtt = get_board_channel().request(b'rebind')
+    if args.verbose and not args.interactive:
+        print(f'Board reloaded bindings in {rtt * 1000:.1f} ms')
+    return rtt
+
+
+def apply_bindings_file(file_path, change_time=None):
+    global board_bindings
+    try:
+        bindings = import_bindings(file_path)
+    except BoardException as e:
+        e.print()
+        return
+
+    if args.dry_run:
+        changes = diff_bindings(board_bindings, bindings)
+    else:
+        # A board that times out, rejects the bindings or is unplugged
+        # gets them again with the next save
+        previous_bindings = board_bindings
+        try:
+            changes = sync_bindings(bindings)
+        except BoardException as e:
+            board_bindings = previous_bindings
+            e.print()
+            return
+        except OSError as e:
+            # Reopened with the next save
+            if board_serial:
+                board_serial.close()
+            board_bindings = previous_bindings
+            print(f'Could not apply \'{file_path}\': {e}')
+            return
+    if not changes:
+        return
+
+    for button, key in format_bindings(changes).items():
+        print(f'{button}: {key}')
+    if change_time is not None:
+        latency = time.perf_counter() - change_time
+        print(f'Applied {len(changes)} change(s) in {latency * 1000:.0f} ms')
+
+
+def watch_bindings(file_path):
+    apply_bindings_file(file_path)
+    print(f'Watching \'{file_path}\' for changes, press Ctrl+C to stop.')
+    try:
+        watch_file(
+            file_path,
+            lambda change_time: apply_bindings_file(file_path, change_time)
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+def print_board_stats():
+    data, rtt = get_board_channel().request(b'stats')
+    gc_runs, gc_forced_runs, gc_worst_pause_us, mem_free = struct.unpack(
+        '<IIII', data
+    )
+    print(f'GC runs:         {gc_runs} ({gc_forced_runs} forced)')
+    print(f'Worst GC pause:  {gc_worst_pause_us / 1000:.2f} ms')
+    print(f'Free memory:     {mem_free} bytes')
+    if args.verbose:
+        print(f'Round-trip time: {rtt * 1000:.1f} ms')
+
+
+def print_boot_times():
+    data, rtt = get_board_channel().request(b'boot')
+    phases = [line.split() for line in data.decode().splitlines()]
+    prev_ticks = 0
+    print('Phase       Since reset    Duration')
+    for name, ticks in phases:
+        ticks = int(ticks)
+        print(f'{name:<12}{ticks:>8} ms {ticks - prev_ticks:>8} ms')
+        prev_ticks = ticks
+    if args.verbose:
+        print(f'Round-trip time: {rtt * 1000:.1f} ms')
 
 
 def main():
-    global config_file_path, args
-    board_path = args.path if args.path else get_board_path()
-    write = False
-    config_file_path = board_path + 'bindings.json'
-    bindings = get_bindings(config_file_path)
+    global config_file_path, board_bindings, args
+    if args.json:
+        config_file_path = (board_path or get_board_path()) + 'bindings.json'
+    board_bindings = read_bindings()
+    bindings = board_bindings.copy()
+
+    if args.import_path:
+        bindings = import_bindings(args.import_path)
 
     if args.bindings:
         for button, key in args.bindings:
             bindings[button] = HID_KEY_CODES[key]
-        write = True
+
+    if args.hold_bindings:
+        for button, tap_key, hold_key in args.hold_bindings:
+            bindings[button] = make_hold_binding(
+                HID_KEY_CODES[tap_key],
+                HID_KEY_CODES[hold_key],
+                args.hold_time,
+                args.hold_policy,
+            )
 
     if args.bindings_to_remove:
         for button in args.bindings_to_remove:
             bindings[button] = None
-        write = True
 
     if args.clear:
         bindings = {
@@ -278,18 +541,60 @@ def main():
     if args.interactive:
         custom_curses_wrapper(run_interactive_mode, bindings)
 
-    if not args.dry_run and (write or args.interactive):
-        write_bindings(bindings)
-        if args.reload:
-            reload_bindings()
+    if not args.dry_run:
+        sync_bindings(bindings)
+
+    if args.export_path:
+        export_bindings(args.export_path, bindings)
 
     if args.list:
         print_bindings(bindings)
 
+    if args.stats:
+        print_board_stats()
+
+    if args.boot_times:
+        print_boot_times()
+
+    if args.watch_path:
+        watch_bindings(args.watch_path)
+
+
+def find_board_config():
+    global board_path
+    # The drive is only looked for when bindings.json is used, the NVM
+    # commands work without it
+    board_path = args.path
+    if not board_path and args.json:
+        try:
+            board_path = get_board_path()
+        except BoardException:
+            return
+    if board_path and os.path.exists(board_path + 'config.json'):
+        load_board_config(board_path + 'config.json')
+
+
+def validate_button_args():
+    for dest in ('bindings', 'hold_bindings'):
+        bindings = getattr(args, dest)
+        if bindings:
+            setattr(args, dest, [
+                (validate_button_type(button), *keys)
+                for button, *keys in bindings
+            ])
+    if args.bindings_to_remove:
+        args.bindings_to_remove = [
+            validate_button_type(button)
+            for button in args.bindings_to_remove
+        ]
+
 
 def setup():
-    global args, board_serial, released_key, pressed_key
+    global args, board_bindings, board_serial, board_channel
+    global released_key, pressed_key
+    board_bindings = {}
     board_serial = None
+    board_channel = None
     pressed_key = None
     released_key = None
     arg_parser = argparse.ArgumentParser(
@@ -316,6 +621,29 @@ def setup():
         dest='bindings',
         help='bind a pad button with a keyboard key'
     )
+    binding_group.add_argument(
+        '-H', '--hold',
+        action=ValidateBindingAction,
+        nargs=3,
+        metavar=('BTN', 'TAP', 'HOLD'),
+        dest='hold_bindings',
+        help='bind a pad button with a key on tap and another while held'
+    )
+    binding_group.add_argument(
+        '--hold-time',
+        metavar='MS',
+        type=validate_hold_time_type,
+        default=binding_store.DEFAULT_HOLD_TIME,
+        help='time a button must be held to use its hold key (-H)'
+    )
+    binding_group.add_argument(
+        '--hold-policy',
+        choices=POLICY_NAMES,
+        default='hold',
+        help='what other keys pressed before the hold time do: ' +
+             'select tap (tap), select hold when pressed (hold) or when ' +
+             'tapped (permissive) (-H)'
+    )
     binding_group.add_argument(
         '-c', '--clear',
         action='store_true',
@@ -323,17 +651,43 @@ def setup():
     )
     binding_group.add_argument(
         '-r', '--remove',
-        type=validate_button_type,
         nargs='+',
         metavar='BTN',
         dest='bindings_to_remove',
         help='remove a pad button binding'
     )
+    binding_group.add_argument(
+        '--import',
+        metavar='FILE',
+        type=validate_file_type,
+        dest='import_path',
+        help='replace all bindings with the ones in a JSON file'
+    )
+    binding_group.add_argument(
+        '-w', '--watch',
+        metavar='FILE',
+        type=validate_file_type,
+        dest='watch_path',
+        help='apply a JSON bindings file every time it is saved'
+    )
+    binding_group.add_argument(
+        '--export',
+        metavar='FILE',
+        dest='export_path',
+        help='save the resulting bindings to a JSON file'
+    )
+    arg_parser.add_argument(
+        '-j', '--json',
+        action='store_true',
+        help='store bindings in the bindings.json file of the mounted ' +
+             'board instead of its NVM'
+    )
     arg_parser.add_argument(
         '-n', '--no-reload',
         action='store_false',
         dest='reload',
-        help='do not reload board bindings'
+        help='do not reload board bindings, the board loads a changed ' +
+             'bindings.json at its next boot instead (-j)'
     )
     arg_parser.add_argument(
         '-e', '--write-on-exit',
@@ -345,6 +699,21 @@ def setup():
         action='store_true',
         help='list all bindings'
     )
+    arg_parser.add_argument(
+        '-s', '--stats',
+        action='store_true',
+        help='show board garbage collection stats'
+    )
+    arg_parser.add_argument(
+        '-t', '--boot-times',
+        action='store_true',
+        help='show how long each board startup phase took'
+    )
+    arg_parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='report board command round-trip times'
+    )
     arg_parser.add_argument(
         '-d', '--dry-run',
         action='store_true',
@@ -363,6 +732,12 @@ def setup():
         help='specify the port for the programmable board'
     )
     args = arg_parser.parse_args()
+    # Buttons are checked against the board's config.json
+    find_board_config()
+    try:
+        validate_button_args()
+    except argparse.ArgumentTypeError as e:
+        arg_parser.error(str(e))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+import importlib.util
+import os
+import sys
+import threading
+import time
+import tty
+
+import pytest
+import serial
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pynput needs a display unless its dummy backend is used
+os.environ.setdefault('PYNPUT_BACKEND', 'dummy')
+
+import binding_tables  # NOQA: E402
+import fake_circuitpython  # NOQA: E402
+import utils  # NOQA: E402
+
+
+@pytest.fixture
+def firmware(tmp_path, monkeypatch):
+    """Returns a function that boots board/main.py on fake hardware."""
+    def boot(**kwargs):
+        return fake_circuitpython.boot_firmware(
+            monkeypatch, tmp_path, **kwargs
+        )
+
+    return boot
+
+
+@pytest.fixture
+def pty_pair():
+    master, slave = os.openpty()
+    tty.setraw(master)
+    host_serial = serial.Serial(os.ttyname(slave), timeout=0)
+    yield master, host_serial
+    host_serial.close()
+    os.close(slave)
+    os.close(master)
+
+
+@pytest.fixture
+def pty_board(firmware, pty_pair):
+    # Firmware serving commands on the master side, host on the slave side
+    master, host_serial = pty_pair
+    main = firmware()
+    main.uart = fake_circuitpython.PtySerial(master)
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            if main.uart.in_waiting:
+                main.read_commands()
+            else:
+                time.sleep(0.0005)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield main, utils.CommandChannel(host_serial)
+    stop.set()
+    thread.join()
+
+
+@pytest.fixture
+def map_keys(monkeypatch):
+    spec = importlib.util.spec_from_file_location(
+        'map_keys', os.path.join(fake_circuitpython.ROOT, 'map-keys.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+    binding_tables.load_board_config(binding_tables.BOARD_CONFIG_PATH)
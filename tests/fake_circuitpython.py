@@ -0,0 +1,250 @@
+"""Minimal stand-ins for the CircuitPython modules used by the firmware.
+
+Only the behaviour the firmware relies on is implemented, so that
+board/main.py can be imported and driven from the host.
+"""
+
+import collections
+import fcntl
+import importlib
+import json
+import os
+import sys
+import termios
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOARD_DIR = os.path.join(ROOT, 'board')
+for path in (ROOT, BOARD_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+TICKS_PERIOD = 1 << 29
+# CircuitPython starts supervisor.ticks_ms() close to wrapping
+TICKS_ORIGIN = 0x1FFF0000
+
+
+class Clock:
+    def __init__(self):
+        self.ms = 0
+
+    def ticks_ms(self):
+        return (TICKS_ORIGIN + self.ms) % TICKS_PERIOD
+
+
+class Event:
+    def __init__(self, key_number=0, pressed=True, timestamp=None):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.released = not pressed
+        self.timestamp = timestamp
+
+
+class EventQueue:
+    def __init__(self):
+        self.queue = collections.deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __bool__(self):
+        return bool(self.queue)
+
+    def get_into(self, event):
+        if not self.queue:
+            return False
+        key_number, pressed, timestamp = self.queue.popleft()
+        event.key_number = key_number
+        event.pressed = pressed
+        event.released = not pressed
+        event.timestamp = timestamp
+        return True
+
+
+class Keys:
+    def __init__(self, pins, value_when_pressed, pull=True, interval=0.02):
+        self.pins = pins
+        self.key_count = len(pins)
+        self.events = EventQueue()
+
+
+class KeyMatrix:
+    def __init__(
+        self, row_pins, column_pins, columns_to_anodes=True, interval=0.02
+    ):
+        self.row_pins = row_pins
+        self.column_pins = column_pins
+        self.key_count = len(row_pins) * len(column_pins)
+        self.events = EventQueue()
+
+
+class AnalogIn:
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 32768
+
+
+class DigitalInOut:
+    def __init__(self, pin):
+        self.pin = pin
+        self.direction = None
+        self.pull = None
+        self.value = False
+
+
+class HidDevice:
+    def __init__(self, usage):
+        self.usage = usage
+        self.reports = []
+
+    def send_report(self, report):
+        self.reports.append(bytes(report))
+
+
+class Nvm(bytearray):
+    def __init__(self, size=4096):
+        super().__init__(b'\xff' * size)
+        self.writes = 0
+
+    def __setitem__(self, index, value):
+        self.writes += 1
+        super().__setitem__(index, value)
+
+
+class Gc:
+    def __init__(self):
+        self.collections = 0
+        self.free = 64 * 1024
+        self.alloc = 1024
+        self.stat_calls = 0
+
+    def collect(self):
+        self.collections += 1
+        self.alloc = 0
+
+    def disable(self):
+        pass
+
+    def enable(self):
+        pass
+
+    def mem_free(self):
+        self.stat_calls += 1
+        return self.free
+
+    def mem_alloc(self):
+        self.stat_calls += 1
+        return self.alloc
+
+
+class Serial:
+    """usb_cdc.data backed by an in-memory buffer."""
+
+    def __init__(self):
+        self.timeout = 0
+        self.rx = bytearray()
+        self.tx = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def readinto(self, buffer):
+        n = min(len(buffer), len(self.rx))
+        if not n:
+            return None
+        buffer[:n] = self.rx[:n]
+        del self.rx[:n]
+        return n
+
+    def write(self, data):
+        self.tx += data
+        return len(data)
+
+
+class PtySerial:
+    """usb_cdc.data backed by the master side of a pty."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.timeout = 0
+
+    @property
+    def in_waiting(self):
+        data = fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0')
+        return int.from_bytes(data, 'little')
+
+    def readinto(self, buffer):
+        if not self.in_waiting:
+            return None
+        return os.readv(self.fd, [buffer])
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+
+def install(monkeypatch):
+    """Register the fake modules and return them by name."""
+    clock = Clock()
+    devices = {
+        0x06: HidDevice(0x06),
+        0x02: HidDevice(0x02),
+    }
+
+    def find_device(devices_, usage_page, usage):
+        return devices[usage]
+
+    board = types.ModuleType('board')
+    board.__getattr__ = lambda name: name
+    modules = {
+        'board': board,
+        'digitalio': types.SimpleNamespace(
+            DigitalInOut=DigitalInOut,
+            Direction=types.SimpleNamespace(INPUT='input', OUTPUT='output'),
+            Pull=types.SimpleNamespace(UP='up', DOWN='down'),
+        ),
+        'usb_hid': types.SimpleNamespace(devices=[]),
+        'usb_cdc': types.SimpleNamespace(data=Serial()),
+        'keypad': types.SimpleNamespace(
+            Event=Event, Keys=Keys, KeyMatrix=KeyMatrix
+        ),
+        'supervisor': types.SimpleNamespace(
+            ticks_ms=clock.ticks_ms, clock=clock
+        ),
+        'analogio': types.SimpleNamespace(AnalogIn=AnalogIn),
+        'microcontroller': types.SimpleNamespace(nvm=Nvm()),
+        'adafruit_hid': types.SimpleNamespace(
+            find_device=find_device, devices=devices
+        ),
+    }
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    return modules
+
+
+def boot_firmware(
+    monkeypatch, directory, config=None, bindings=None, nvm=None,
+    run_setup=True,
+):
+    """Import board/main.py on fake hardware, with directory as CIRCUITPY."""
+    modules = install(monkeypatch)
+    monkeypatch.chdir(directory)
+    if config is None:
+        with open(os.path.join(BOARD_DIR, 'config.json')) as fp:
+            config = json.load(fp)
+    with open('config.json', 'w') as fp:
+        json.dump(config, fp)
+    if bindings is not None:
+        with open('bindings.json', 'w') as fp:
+            json.dump(bindings, fp)
+    if nvm is not None:
+        modules['microcontroller'].nvm[:len(nvm)] = nvm
+        modules['microcontroller'].nvm.writes = 0
+
+    monkeypatch.delitem(sys.modules, 'main', raising=False)
+    main = importlib.import_module('main')
+    main.gc = Gc()
+    main.hw = modules
+    if run_setup:
+        main.setup()
+    return main
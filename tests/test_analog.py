@@ -0,0 +1,155 @@
+import pytest
+
+from analog import AnalogAxis, AXIS_MAX
+
+
+def settle(axis, raw, batches=50):
+    for _ in range(batches * axis.oversample):
+        axis.add_sample(raw)
+
+
+@pytest.mark.parametrize('deadzone', [0, 2048, 8000])
+def test_deadzone_rescaling(deadzone):
+    axis = AnalogAxis(deadzone=deadzone)
+    assert axis.scale(0) == 0
+    assert axis.scale(deadzone) == axis.scale(-deadzone) == 0
+    assert axis.scale(deadzone + 1) == 1
+    assert axis.scale(AXIS_MAX) == AXIS_MAX
+    assert axis.scale(-AXIS_MAX - 1) == -AXIS_MAX
+
+    values = [axis.scale(offset) for offset in range(0, AXIS_MAX, 97)]
+    assert values == sorted(values)
+    for offset in range(0, AXIS_MAX, 97):
+        assert axis.scale(-offset) == -axis.scale(offset)
+
+
+def test_oversampling_averages_each_batch():
+    axis = AnalogAxis(oversample=4, smoothing=0, deadzone=0)
+    assert [axis.add_sample(raw) for raw in (100, 200, 300)] == [False] * 3
+    assert axis.filtered == axis.center
+    assert axis.add_sample(400)
+    assert axis.filtered == 250
+
+
+def test_moving_average_steps_by_its_weight():
+    axis = AnalogAxis(oversample=1, smoothing=2, deadzone=0)
+    axis.add_sample(axis.center + 4000)
+    assert axis.filtered == axis.center + 1000
+    axis.add_sample(axis.center + 4000)
+    assert axis.filtered == axis.center + 1750
+
+    settle(axis, axis.center + 4000)
+    # Arithmetic shifts leave up to 2**smoothing - 1 when rising
+    assert 0 <= axis.center + 4000 - axis.filtered < 4
+    settle(axis, axis.center)
+    assert axis.filtered == axis.center
+    assert axis.value == 0
+
+
+def test_hysteresis_around_the_threshold():
+    axis = AnalogAxis(threshold=16384, hysteresis=2048)
+    assert axis.get_direction(16383) == 0
+    axis.direction = axis.get_direction(16384)
+    assert axis.direction == 1
+    assert axis.get_direction(16384 - 2048 + 1) == 1
+    assert axis.get_direction(16384 - 2048) == 0
+
+    axis.direction = axis.get_direction(-16384)
+    assert axis.direction == -1
+    assert axis.get_direction(-16384 + 2048 - 1) == -1
+    assert axis.get_direction(-16384 + 2048) == 0
+
+
+def test_noise_at_the_threshold_does_not_chatter():
+    axis = AnalogAxis(oversample=1, smoothing=0, deadzone=0)
+    raw = axis.center + 16384
+    changes = 0
+    direction = 0
+    for i in range(200):
+        axis.add_sample(raw + (1500 if i % 2 else -1500))
+        if axis.direction != direction:
+            direction = axis.direction
+            changes += 1
+    assert changes == 1
+    assert direction == 1
+    axis.reset()
+    assert (axis.filtered, axis.value, axis.direction) == (axis.center, 0, 0)
+
+
+ANALOG_CONFIG = {
+    'scan': 'direct',
+    'buttons': ['a', 'left', 'right'],
+    'pins': {'a': 'GP0'},
+    'analog': [{
+        'pin': 'A0', 'low': 'left', 'high': 'right',
+        'oversample': 1, 'smoothing': 0,
+    }],
+}
+
+
+def test_held_direction_counts_as_pressed(firmware):
+    main = firmware(config=ANALOG_CONFIG, bindings={'left': 0x50})
+    channel = main.analog_channels[0]
+    clock = main.hw['supervisor'].clock
+    keyboard = main.hw['adafruit_hid'].devices[0x06]
+
+    channel.value = 0
+    main.scan()
+    assert main.pressed_count == 1
+    assert keyboard.reports[-1][2] == 0x50
+
+    # Held long past the idle window: no idle collection
+    clock.ms += 10 * main.GC_CHECK_MS
+    main.scan()
+    main.scan()
+    assert main.gc.collections == 0
+
+    channel.value = 65535
+    main.scan()
+    assert main.pressed_count == 1
+    assert keyboard.reports[-1][2] == 0
+    channel.value = 32768
+    main.scan()
+    assert main.pressed_count == 0
+
+
+MOUSE_CONFIG = {
+    'scan': 'direct',
+    'buttons': ['a'],
+    'pins': {'a': 'GP0'},
+    'analog': [
+        {'pin': 'A0', 'mouse': 'x', 'speed': 8, 'oversample': 1,
+         'smoothing': 0},
+        {'pin': 'A1', 'mouse': 'y', 'speed': 8, 'oversample': 1,
+         'smoothing': 0},
+    ],
+}
+
+
+@pytest.mark.parametrize('offset, delta', [
+    (2048 + 162, 0),
+    (2048 + 4215, 1),
+    (2048 + 8192, 2),
+    (32767, 8),
+])
+def test_mouse_reports_are_symmetric(firmware, offset, delta):
+    main = firmware(config=MOUSE_CONFIG)
+    mouse = main.hw['adafruit_hid'].devices[0x02]
+    clock = main.hw['supervisor'].clock
+    x, y = main.analog_channels
+    reports = []
+    for sign in (1, -1):
+        x.value = 32768 + sign * offset
+        y.value = 32768 - sign * offset
+        mouse.reports.clear()
+        clock.ms += main.MOUSE_INTERVAL_MS
+        main.scan()
+        clock.ms += main.MOUSE_INTERVAL_MS
+        main.scan()
+        reports.append(mouse.reports[-1] if mouse.reports else bytes(4))
+
+    signed = [
+        [byte - 256 if byte > 127 else byte for byte in report[1:3]]
+        for report in reports
+    ]
+    assert signed == [[delta, -delta], [-delta, delta]]
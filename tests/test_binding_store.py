@@ -0,0 +1,150 @@
+import json
+import os
+
+import pytest
+
+import binding_store
+from framing import encode_frame, FrameDecoder, NAK
+
+
+def make_table(count):
+    table = bytearray(count * binding_store.ENTRY_SIZE)
+    for i in range(count):
+        entry = i * binding_store.ENTRY_SIZE
+        table[entry] = 0x04 + i % 26
+        if i % 3 == 0:
+            table[entry + 1] = 0xE0 + i % 8
+            table[entry + 2] = binding_store.pack_hold(
+                10 * (i % 63 + 1), i % 3
+            )
+    return table
+
+
+@pytest.mark.parametrize('count', [0, 1, 10, 255])
+def test_round_trip(count):
+    table = make_table(count)
+    data = binding_store.encode(table)
+    assert len(data) == binding_store.encoded_size(count)
+
+    decoded = bytearray(b'\xff' * len(table))
+    binding_store.decode_into(data + b'\xff' * 16, decoded)
+    assert decoded == table
+
+
+@pytest.mark.parametrize(
+    'hold_time', [10, 200, binding_store.HOLD_TIME_MAX]
+)
+@pytest.mark.parametrize('policy', [0, 1, 2])
+def test_hold_settings_round_trip(hold_time, policy):
+    setting = binding_store.pack_hold(hold_time, policy)
+    assert 0 <= setting <= 0xFF
+    assert binding_store.unpack_hold(setting) == (hold_time, policy)
+
+
+def test_version_1_tables_have_no_hold_keys():
+    data = bytearray(b'MPB\x01\x02\x04\x05')
+    crc = binding_store.crc16(data, len(data))
+    data += bytes((crc & 0xFF, crc >> 8))
+    table = bytearray(b'\xff' * 6)
+    binding_store.decode_into(data, table)
+    assert table == b'\x04\x00\x00\x05\x00\x00'
+
+
+@pytest.mark.parametrize('change, message', [
+    (lambda data: data[:-1], 'size mismatch'),
+    (lambda data: b'MPX' + data[3:], 'no binding table'),
+    (lambda data: data[:3] + b'\x09' + data[4:], 'unsupported'),
+    (lambda data: data[:5] + b'\x99' + data[6:], 'checksum mismatch'),
+])
+def test_invalid_tables_leave_the_table_untouched(change, message):
+    table = make_table(3)
+    data = change(binding_store.encode(table))
+    decoded = bytearray(b'\xaa' * len(table))
+    with pytest.raises(ValueError, match=message):
+        binding_store.decode_into(data, decoded)
+    assert decoded == b'\xaa' * len(table)
+
+
+def test_table_count_must_match_the_buttons():
+    data = binding_store.encode(make_table(3))
+    with pytest.raises(ValueError, match='size mismatch'):
+        binding_store.decode_into(data, bytearray(4 * 3))
+
+
+@pytest.mark.parametrize('bindings, message', [
+    ([], 'must be an object'),
+    ({'cross': 'a'}, 'invalid keycode for cross'),
+    ({'cross': 300}, 'invalid keycode for cross'),
+    ({'cross': {'tap': 4}}, 'no hold keycode for cross'),
+    ({'cross': {'tap': 4, 'hold': 'x'}}, 'invalid keycode for cross'),
+    ({'cross': {'hold': 5, 'hold_time': 5000}}, 'invalid hold time'),
+    ({'cross': {'hold': 5, 'policy': 'never'}}, 'invalid hold policy'),
+])
+def test_invalid_bindings_file_is_rejected(firmware, bindings, message):
+    main = firmware(bindings={'cross': 0x04})
+    table = bytes(main.binding_table)
+    with open('bindings.json', 'w') as fp:
+        json.dump(bindings, fp)
+
+    main.uart.rx += encode_frame(1, b'rebind')
+    main.read_commands()
+    (seq, payload), = FrameDecoder().feed(main.uart.tx)
+    assert payload[0] == NAK
+    assert message in payload[1:].decode()
+    assert main.binding_table == table
+
+
+def test_invalid_bindings_file_at_boot_falls_back_to_nvm(firmware):
+    main = firmware(bindings={'cross': 0x04})
+    nvm = bytes(main.hw['microcontroller'].nvm)
+    with open('bindings.json', 'w') as fp:
+        fp.write('{"cross": "a", "circle": 5}')
+
+    main = firmware(nvm=nvm)
+    assert main.keycode_per_key[main.KEY_PER_BTN['cross']] == 0x04
+    assert main.keycode_per_key[main.KEY_PER_BTN['circle']] is None
+
+
+def test_changed_bindings_file_wins_over_nvm(firmware):
+    def reboot(nvm):
+        main = firmware(nvm=nvm)
+        return main, main.keycode_per_key[main.KEY_PER_BTN['cross']]
+
+    main = firmware(bindings={'cross': 0x04})
+    nvm = bytes(main.hw['microcontroller'].nvm)
+    main, keycode = reboot(nvm)
+    assert keycode == 0x04
+    assert main.hw['microcontroller'].nvm.writes == 0
+
+    # Bindings put by map-keys.py win until bindings.json changes
+    table = bytearray(main.binding_table)
+    table[main.BUTTONS.index('cross') * binding_store.ENTRY_SIZE] = 0x05
+    main.put_bindings(binding_store.encode(table))
+    nvm = bytes(main.hw['microcontroller'].nvm)
+    main, keycode = reboot(nvm)
+    assert keycode == 0x05
+
+    with open('bindings.json', 'w') as fp:
+        json.dump({'cross': 0x06}, fp)
+    stat = os.stat('bindings.json')
+    os.utime('bindings.json', (stat.st_atime, stat.st_mtime + 2))
+    main, keycode = reboot(nvm)
+    assert keycode == 0x06
+
+
+def test_crc16_check_value():
+    assert binding_store.crc16(b'123456789', 9) == 0x29B1
+    assert binding_store.crc16(b'123456789xx', 9) == 0x29B1
+
+
+def test_boot_does_not_list_the_drive(firmware, monkeypatch):
+    def listdir(*args):
+        raise AssertionError('os.listdir() at boot')
+
+    main = firmware(run_setup=False)
+    monkeypatch.setattr(main.os, 'listdir', listdir)
+    main.setup()
+    with open('bindings.json', 'w') as fp:
+        json.dump({'cross': 0x04}, fp)
+    main.setup()
+    assert main.keycode_per_key[main.KEY_PER_BTN['cross']] == 0x04
@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+import utils
+from framing import ACK, encode_frame, FrameDecoder, NAK
+
+
+def test_decoder_skips_garbage_and_waits_for_split_frames():
+    decoder = FrameDecoder()
+    frame = encode_frame(7, b'hello')
+    assert decoder.feed(b'\x00junk' + frame[:4]) == []
+    assert decoder.feed(frame[4:] + encode_frame(8, b'')) == [
+        (7, b'hello'), (8, b''),
+    ]
+
+
+def test_board_handles_split_and_pipelined_frames(firmware):
+    main = firmware()
+    frames = encode_frame(1, b'stats') + encode_frame(2, b'nope')
+    main.uart.rx += b'\x13' + frames[:6]
+    main.read_commands()
+    assert main.uart.tx == b''
+    main.uart.rx += frames[6:10]
+    main.read_commands()
+    assert FrameDecoder().feed(main.uart.tx)[0][0] == 1
+    main.uart.rx += frames[10:]
+    main.read_commands()
+
+    responses = FrameDecoder().feed(main.uart.tx)
+    assert [(seq, payload[0]) for seq, payload in responses] == [
+        (1, ACK), (2, NAK),
+    ]
+    assert main.rx_len == 0
+
+
+def test_pipelined_commands_are_acknowledged(pty_board):
+    main, channel = pty_board
+    seqs = [channel.send(b'stats') for _ in range(3)]
+    seqs.append(channel.send(b'get'))
+    responses = channel.wait(seqs)
+
+    assert sorted(responses) == sorted(seqs)
+    assert all(rtt > 0 for _, rtt in responses.values())
+    assert responses[seqs[-1]][0] == main.get_bindings(b'')
+
+
+def test_rejected_command_raises(pty_board):
+    _, channel = pty_board
+    with pytest.raises(utils.BoardException, match='unknown command'):
+        channel.request(b'nope')
+
+
+def test_timed_out_request_ignores_late_ack(pty_pair):
+    master, host_serial = pty_pair
+    channel = utils.CommandChannel(host_serial)
+    seq = channel.send(b'rebind')
+    with pytest.raises(utils.BoardException, match='did not acknowledge'):
+        channel.wait([seq], timeout=0.05)
+
+    # The late ACK arrives before the sequence number is reused
+    os.write(master, encode_frame(seq, bytes((ACK,))))
+    time.sleep(0.05)
+    channel.next_seq = seq
+    assert channel.send(b'rebind') == seq
+    with pytest.raises(utils.BoardException, match='did not acknowledge'):
+        channel.wait([seq], timeout=0.05)
@@ -0,0 +1,117 @@
+import binding_store
+from framing import ACK, encode_frame, FrameDecoder, NAK
+
+
+def test_gc_stats_are_checked_at_an_interval(firmware):
+    main = firmware()
+    clock = main.hw['supervisor'].clock
+    for _ in range(1000):
+        main.scan()
+    assert main.gc.stat_calls == 0
+
+    clock.ms += main.GC_CHECK_MS
+    for _ in range(1000):
+        main.scan()
+    # mem_free(), mem_alloc() while idle and once more after collecting
+    assert main.gc.stat_calls == 3
+    assert main.gc.collections == 1
+
+
+def test_low_memory_forces_a_collection(firmware):
+    main = firmware()
+    main.gc.free = main.GC_MIN_FREE - 1
+    main.pressed_count = 1
+    main.hw['supervisor'].clock.ms += main.GC_CHECK_MS
+    # The first pass ends the boot blink
+    main.scan()
+    main.scan()
+    assert main.gc_forced_runs == 1
+
+
+def test_frames_longer_than_a_read_chunk(firmware):
+    main = firmware()
+    frame = encode_frame(3, b'put ' + bytes(200))
+    main.uart.rx += frame + encode_frame(4, b'stats')
+    while main.uart.in_waiting:
+        main.read_commands()
+
+    responses = FrameDecoder().feed(main.uart.tx)
+    assert [seq for seq, _ in responses] == [3, 4]
+    assert responses[1][1][0] == ACK
+    assert main.rx_len == 0
+
+
+def test_boot_phases_are_milliseconds_since_reset(firmware):
+    main = firmware(run_setup=False)
+    clock = main.hw['supervisor'].clock
+    clock.ms = 1200
+    main.setup()
+    clock.ms = 1250
+    main.mark_phase('scan')
+    assert [name for name, _ in main.boot_phases] == [
+        'imports', 'config', 'pins', 'bindings', 'hid', 'scan',
+    ]
+    assert main.boot_phases[0][1] == 1200
+    assert main.boot_phases[-1][1] == 1250
+
+    # The first report that reaches the host is marked once
+    keyboard = main.hw['adafruit_hid'].devices[0x06]
+    keyboard.send_report = fail_send_report
+    clock.ms = 1300
+    main.press_key(0x04)
+    keyboard.send_report = keyboard.reports.append
+    clock.ms = 1400
+    main.release_key(0x04)
+    main.press_key(0x04)
+    assert main.boot_phases[-1] == ('first_report', 1400)
+    assert len(main.boot_phases) == 7
+    assert main.boot_times(b'').endswith(b'scan 1250\nfirst_report 1400')
+
+
+def fail_send_report(report):
+    raise OSError('not enumerated')
+
+
+def test_blink_does_not_block_the_scan(firmware, monkeypatch):
+    main = firmware(bindings={'cross': 0x04})
+    monkeypatch.setattr(main.time, 'sleep', None)
+    clock = main.hw['supervisor'].clock
+    led = main.led
+    assert led.value
+
+    main.scan()
+    assert led.value
+    clock.ms += main.LED_BLINK_MS
+    main.scan()
+    assert not led.value
+
+    main.uart.rx += encode_frame(1, b'rebind')
+    main.scan()
+    assert led.value
+    assert FrameDecoder().feed(main.uart.tx)[0][1][0] == ACK
+    clock.ms += main.LED_BLINK_MS - 1
+    main.scan()
+    assert led.value
+    clock.ms += 1
+    main.scan()
+    assert not led.value
+
+
+def test_set_updates_only_the_given_buttons(firmware):
+    main = firmware(bindings={'cross': 0x04, 'circle': 0x05})
+    nvm = main.hw['microcontroller'].nvm
+    cross = main.BUTTONS.index('cross')
+    circle = main.BUTTONS.index('circle')
+    main.uart.rx += encode_frame(1, b'set ' + bytes((cross, 0x06, 0, 0)))
+    main.uart.rx += encode_frame(2, b'set ' + bytes((0xFF, 0x06, 0, 0)))
+    main.uart.rx += encode_frame(3, b'set ' + bytes((cross, 0x06, 0)))
+    main.read_commands()
+
+    responses = FrameDecoder().feed(main.uart.tx)
+    assert [payload[0] for _, payload in responses] == [ACK, NAK, NAK]
+    assert main.keycode_per_key[main.KEY_PER_BTN['cross']] == 0x06
+    assert main.keycode_per_key[main.KEY_PER_BTN['circle']] == 0x05
+    table = bytearray(len(main.binding_table))
+    binding_store.decode_into(nvm, table)
+    assert table[cross * binding_store.ENTRY_SIZE] == 0x06
+    assert table[circle * binding_store.ENTRY_SIZE] == 0x05
@@ -0,0 +1,314 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import binding_store
+import binding_tables
+import utils
+from binding_tables import HID_KEY_CODES
+from framing import FRAME_MAX_PAYLOAD
+
+
+def test_buttons_come_from_the_board_config(map_keys, tmp_path, monkeypatch):
+    with open(tmp_path / 'config.json', 'w') as fp:
+        json.dump({'buttons': ['play', 'next'], 'pins': {}}, fp)
+    monkeypatch.setattr(
+        sys, 'argv', ['map-keys.py', '-f', str(tmp_path), '-b', 'next', 'a']
+    )
+    map_keys.setup()
+
+    assert map_keys.BUTTON_NAMES == {1: 'play', 2: 'next'}
+    assert map_keys.args.bindings == [('next', 'a')]
+    assert map_keys.board_path == str(tmp_path) + '/'
+
+
+def test_buttons_missing_from_the_board_config_are_rejected(
+    map_keys, tmp_path, monkeypatch
+):
+    with open(tmp_path / 'config.json', 'w') as fp:
+        json.dump({'buttons': ['play', 'next'], 'pins': {}}, fp)
+    monkeypatch.setattr(
+        sys, 'argv', ['map-keys.py', '-f', str(tmp_path), '-b', 'cross', 'a']
+    )
+    with pytest.raises(SystemExit):
+        map_keys.setup()
+
+
+def test_board_is_only_looked_for_with_json(map_keys, tmp_path, monkeypatch):
+    def get_board_path():
+        calls.append(True)
+        return str(tmp_path) + '/'
+
+    calls = []
+    monkeypatch.setattr(map_keys, 'get_board_path', get_board_path)
+    monkeypatch.setattr(
+        sys, 'argv', ['map-keys.py', '-s', '-b', 'cross', 'a', '-r', '1']
+    )
+    map_keys.setup()
+    assert calls == []
+    assert map_keys.board_path is None
+    assert map_keys.args.bindings == [('cross', 'a')]
+    assert map_keys.args.bindings_to_remove == ['select']
+
+    with open(tmp_path / 'config.json', 'w') as fp:
+        json.dump({'buttons': ['play', 'next'], 'pins': {}}, fp)
+    monkeypatch.setattr(sys, 'argv', ['map-keys.py', '-jn', '-r', 'next'])
+    map_keys.setup()
+    assert calls == [True]
+    assert map_keys.BUTTON_NAMES == {1: 'play', 2: 'next'}
+
+
+PROFILE = {
+    'cross': 'a',
+    'circle': {'tap': 'b', 'hold': 'ctrl', 'policy': 'permissive'},
+    'square': {'hold': 'shift', 'hold_time': 300},
+}
+
+
+def test_import_export_round_trip(map_keys, tmp_path):
+    profile = tmp_path / 'profile.json'
+    profile.write_text(json.dumps(PROFILE))
+    bindings = utils.import_bindings(profile)
+    assert bindings['cross'] == HID_KEY_CODES['a']
+    assert bindings['circle'] == utils.make_hold_binding(
+        HID_KEY_CODES['b'], HID_KEY_CODES['ctrl'], 200, 'permissive'
+    )
+    assert bindings['square'] == utils.make_hold_binding(
+        None, HID_KEY_CODES['shift'], 300, 'hold'
+    )
+    assert bindings['start'] is None
+
+    exported = tmp_path / 'exported.json'
+    utils.export_bindings(exported, bindings)
+    assert utils.import_bindings(exported) == bindings
+    assert json.loads(exported.read_text())['circle']['hold'] == 'ctrl'
+    assert utils.decode_bindings(utils.encode_bindings(bindings)) == bindings
+
+
+@pytest.mark.parametrize('data, message', [
+    ('[]', 'must be a JSON object'),
+    ('{"cross": ', 'is not valid JSON'),
+    ('{"pedal": "a"}', 'Invalid bindings:'),
+    ('{"cross": "zz"}', 'Invalid bindings:'),
+    ('{"cross": 999}', 'Invalid bindings:'),
+    ('{"cross": {"tap": "a"}}', 'Invalid bindings:'),
+    ('{"cross": {"hold": "a", "hold_time": 5}}', 'Invalid bindings:'),
+    ('{"cross": {"hold": "a", "policy": "never"}}', 'Invalid bindings:'),
+    ('{"cross": {"hold": "a", "repeat": true}}', 'Invalid bindings:'),
+])
+def test_import_rejects_invalid_schemas(map_keys, tmp_path, data, message):
+    profile = tmp_path / 'profile.json'
+    profile.write_text(data)
+    with pytest.raises(utils.BoardException) as e:
+        utils.import_bindings(profile)
+    assert message in e.value.args[0]
+
+
+def test_diff_bindings_only_keeps_changes():
+    old = {'cross': 4, 'circle': None, 'square': {'tap': 4, 'hold': 5}}
+    new = dict(old, circle=6)
+    assert utils.diff_bindings(old, dict(old)) == {}
+    assert utils.diff_bindings(old, new) == {'circle': 6}
+
+
+def test_changes_are_split_into_frames(map_keys, tmp_path):
+    buttons = [f'button_{i}' for i in range(100)]
+    with open(tmp_path / 'config.json', 'w') as fp:
+        json.dump({'buttons': buttons, 'pins': {}}, fp)
+    binding_tables.load_board_config(tmp_path / 'config.json')
+
+    changes = {button: 0x04 for button in buttons}
+    changes['button_7'] = utils.make_hold_binding(None, 0xE0, 300, 'tap')
+    payloads = utils.encode_changes(changes)
+    assert [len(payload) // 4 for payload in payloads] == [62, 38]
+    assert all(len(b'set ' + p) <= FRAME_MAX_PAYLOAD for p in payloads)
+    assert payloads[0][28:32] == bytes(
+        (7, 0, 0xE0, binding_store.pack_hold(300, 0))
+    )
+
+    assert utils.encode_changes({'button_99': None}) == [bytes((99, 0, 0, 0))]
+
+
+def record_commands(channel, monkeypatch):
+    commands = []
+    send = channel.send
+
+    def recording_send(command, data=b''):
+        commands.append(command.split()[0])
+        return send(command, data)
+
+    monkeypatch.setattr(channel, 'send', recording_send)
+    return commands
+
+
+def test_reapplying_a_profile_does_not_write_nvm(
+    map_keys, pty_board, tmp_path, monkeypatch
+):
+    main, channel = pty_board
+    nvm = main.hw['microcontroller'].nvm
+    profile = tmp_path / 'profile.json'
+    profile.write_text(json.dumps(PROFILE))
+    monkeypatch.setattr(sys, 'argv', [
+        'map-keys.py', '-f', str(tmp_path), '--import', str(profile),
+    ])
+    commands = record_commands(channel, monkeypatch)
+
+    map_keys.setup()
+    monkeypatch.setattr(map_keys, 'get_board_channel', lambda: channel)
+    map_keys.main()
+    assert commands == [b'get', b'set']
+    assert nvm.writes
+    cross = main.KEY_PER_BTN['cross']
+    assert main.keycode_per_key[cross] == HID_KEY_CODES['a']
+
+    nvm.writes = 0
+    commands.clear()
+    map_keys.setup()
+    map_keys.main()
+    assert commands == [b'get']
+    assert nvm.writes == 0
+
+    # Only the changed button is sent
+    sent = []
+    monkeypatch.setitem(
+        main.COMMANDS, b'set', lambda args: sent.append(bytes(args))
+    )
+    profile.write_text(json.dumps(dict(PROFILE, cross='c')))
+    commands.clear()
+    map_keys.setup()
+    map_keys.main()
+    assert commands == [b'get', b'set']
+    assert sent == [
+        bytes((main.BUTTONS.index('cross'), HID_KEY_CODES['c'], 0, 0))
+    ]
+
+
+def test_reapplying_a_profile_does_not_rewrite_bindings_json(
+    map_keys, pty_board, tmp_path, monkeypatch
+):
+    main, channel = pty_board
+    nvm = main.hw['microcontroller'].nvm
+    profile = tmp_path / 'profile.json'
+    profile.write_text(json.dumps(PROFILE))
+    monkeypatch.setattr(sys, 'argv', [
+        'map-keys.py', '-j', '-f', str(tmp_path), '--import', str(profile),
+    ])
+    commands = record_commands(channel, monkeypatch)
+
+    map_keys.setup()
+    monkeypatch.setattr(map_keys, 'get_board_channel', lambda: channel)
+    map_keys.main()
+    assert commands == [b'rebind']
+    written = (tmp_path / 'bindings.json').stat()
+
+    nvm.writes = 0
+    commands.clear()
+    map_keys.setup()
+    map_keys.main()
+    assert commands == []
+    assert (tmp_path / 'bindings.json').stat() == written
+    assert nvm.writes == 0
+
+
+def test_watch_keeps_going_after_board_errors(
+    map_keys, pty_board, tmp_path, monkeypatch, capsys
+):
+    # tmp_path is both the firmware's working directory and CIRCUITPY
+    main, channel = pty_board
+    watched = tmp_path / 'edit' / 'bindings.json'
+    watched.parent.mkdir()
+    watched.write_text(json.dumps({'cross': 'a'}))
+    monkeypatch.setattr(sys, 'argv', [
+        'map-keys.py', '-j', '-f', str(tmp_path), '-w', str(watched),
+    ])
+    map_keys.setup()
+    monkeypatch.setattr(map_keys, 'get_board_channel', lambda: channel)
+    cross_key = main.KEY_PER_BTN['cross']
+    keycodes = []
+
+    def reject(args):
+        raise ValueError('busy')
+
+    def save(data):
+        watched.write_text(data)
+        return time.perf_counter()
+
+    def watch_file(file_path, on_change):
+        keycodes.append(main.keycode_per_key[cross_key])
+        on_change(save('{'))
+        monkeypatch.setitem(main.COMMANDS, b'rebind', reject)
+        on_change(save(json.dumps({'cross': 'b'})))
+        keycodes.append(main.keycode_per_key[cross_key])
+        monkeypatch.setitem(main.COMMANDS, b'rebind', main.rebind)
+        on_change(save(json.dumps({'cross': 'b'})))
+        keycodes.append(main.keycode_per_key[cross_key])
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(map_keys, 'watch_file', watch_file)
+    map_keys.main()
+
+    assert keycodes == [0x04, 0x04, 0x05]
+    with open(tmp_path / 'bindings.json') as fp:
+        assert json.load(fp)['cross'] == 0x05
+    output = capsys.readouterr().out
+    assert 'is not valid JSON' in output
+    assert 'The board rejected a command: busy' in output
+    assert output.count('cross: b') == 1
+
+
+class StopWatching(Exception):
+    pass
+
+
+def test_watch_file_calls_back_once_per_save_burst(tmp_path):
+    watched = tmp_path / 'bindings.json'
+    watched.write_text('{}')
+    changes = []
+    burst_done = threading.Event()
+    errors = []
+
+    def on_change(change_time):
+        changes.append(change_time)
+        burst_done.set()
+        if len(changes) == 2:
+            raise StopWatching
+
+    def watch():
+        try:
+            utils.watch_file(watched, on_change, debounce=0.2)
+        except StopWatching:
+            pass
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+
+    # Several quick writes, like an editor saving in place
+    for i in range(3):
+        watched.write_text(json.dumps({'cross': i}))
+        time.sleep(0.02)
+    assert burst_done.wait(2)
+    burst_done.clear()
+    time.sleep(0.3)
+    assert len(changes) == 1
+
+    # Other files in the directory are ignored
+    (tmp_path / 'notes.txt').write_text('x')
+    time.sleep(0.3)
+    assert len(changes) == 1
+
+    # A save that renames a temporary file over the watched one
+    temporary = tmp_path / '.bindings.json.swp'
+    temporary.write_text(json.dumps({'cross': 'a'}))
+    os.replace(temporary, watched)
+    assert burst_done.wait(2)
+    thread.join(2)
+    assert not thread.is_alive()
+    assert errors == []
+    assert len(changes) == 2
@@ -0,0 +1,273 @@
+import pytest
+
+from tap_hold import (
+    HOLD_ON_OTHER_KEY,
+    NO_KEY,
+    PERMISSIVE_HOLD,
+    TAP_PREFERRED,
+    TapHold,
+    TICKS_MASK,
+)
+
+# Key 0 and 1 are dual keys (tap A/B, hold LCTRL/LSHIFT), 2 and 3 plain
+A, B, C, D = 0x04, 0x05, 0x06, 0x07
+LCTRL, LSHIFT = 0xE0, 0xE1
+HOLD_TIME = 200
+TICK = None
+
+
+def make_tap_hold(policy, buffer_size=16):
+    output = []
+    tap_hold = TapHold(
+        bytearray((A, B, C, D)),
+        lambda keycode: output.append(('press', keycode)),
+        lambda keycode: output.append(('release', keycode)),
+        buffer_size,
+    )
+    tap_hold.configure(0, LCTRL, HOLD_TIME, policy)
+    tap_hold.configure(1, LSHIFT, HOLD_TIME, policy)
+    return tap_hold, output
+
+
+def replay(tap_hold, trace, start=1000):
+    # trace: (ms from start, key number or TICK, pressed)
+    for ms, key_number, pressed in trace:
+        now = (start + ms) & TICKS_MASK
+        if key_number is TICK:
+            tap_hold.tick(now)
+        else:
+            tap_hold.key_event(key_number, pressed, now)
+
+
+def press(keycode):
+    return ('press', keycode)
+
+
+def release(keycode):
+    return ('release', keycode)
+
+
+@pytest.mark.parametrize(
+    'policy', [TAP_PREFERRED, HOLD_ON_OTHER_KEY, PERMISSIVE_HOLD]
+)
+def test_tap_and_hold_alone(policy):
+    tap_hold, output = make_tap_hold(policy)
+    replay(tap_hold, [(0, 0, True), (50, TICK, None), (120, 0, False)])
+    assert output == [press(A), release(A)]
+
+    output.clear()
+    replay(tap_hold, [
+        (0, 0, True), (199, TICK, None), (200, TICK, None), (500, 0, False),
+    ])
+    assert output == [press(LCTRL), release(LCTRL)]
+    assert tap_hold.pending_key == NO_KEY
+
+
+def test_hold_is_decided_by_the_release_timestamp():
+    # The loop fell behind: no tick ran before the release was read
+    tap_hold, output = make_tap_hold(TAP_PREFERRED)
+    replay(tap_hold, [(0, 0, True), (250, 0, False)])
+    assert output == [press(LCTRL), release(LCTRL)]
+
+
+def test_tap_preferred_commits_the_tap_before_other_keys():
+    tap_hold, output = make_tap_hold(TAP_PREFERRED)
+    replay(tap_hold, [
+        (0, 0, True), (30, 2, True), (60, 0, False), (90, 2, False),
+    ])
+    assert output == [press(A), press(C), release(A), release(C)]
+
+    output.clear()
+    replay(tap_hold, [
+        (100, 0, True), (130, 2, True), (160, 2, False), (400, 0, False),
+    ])
+    assert output == [press(A), press(C), release(C), release(A)]
+
+
+def test_tap_preferred_lets_releases_through():
+    tap_hold, output = make_tap_hold(TAP_PREFERRED)
+    replay(tap_hold, [
+        (0, 2, True), (30, 0, True), (60, 2, False), (90, 0, False),
+    ])
+    assert output == [press(C), release(C), press(A), release(A)]
+
+
+def test_hold_on_other_key_press():
+    tap_hold, output = make_tap_hold(HOLD_ON_OTHER_KEY)
+    replay(tap_hold, [
+        (0, 0, True), (30, 2, True), (60, 0, False), (90, 2, False),
+    ])
+    assert output == [press(LCTRL), press(C), release(LCTRL), release(C)]
+
+
+def test_permissive_hold_on_other_key_tap():
+    tap_hold, output = make_tap_hold(PERMISSIVE_HOLD)
+    replay(tap_hold, [
+        (0, 0, True), (30, 2, True), (60, 2, False), (90, 0, False),
+    ])
+    assert output == [press(LCTRL), press(C), release(C), release(LCTRL)]
+
+
+def test_permissive_tap_when_released_first():
+    # Rolling from the dual key to another one is two taps
+    tap_hold, output = make_tap_hold(PERMISSIVE_HOLD)
+    replay(tap_hold, [
+        (0, 0, True), (30, 2, True), (60, 0, False), (90, 2, False),
+    ])
+    assert output == [press(A), release(A), press(C), release(C)]
+
+
+def test_permissive_releases_of_keys_held_before_pass_through():
+    tap_hold, output = make_tap_hold(PERMISSIVE_HOLD)
+    replay(tap_hold, [
+        (0, 2, True), (30, 0, True), (60, 2, False), (90, 0, False),
+    ])
+    assert output == [press(C), release(C), press(A), release(A)]
+
+
+@pytest.mark.parametrize('policy, expected', [
+    (TAP_PREFERRED, [
+        press(A), release(A), press(B), release(B),
+    ]),
+    (HOLD_ON_OTHER_KEY, [
+        press(LCTRL), release(LCTRL), press(B), release(B),
+    ]),
+    (PERMISSIVE_HOLD, [
+        press(A), release(A), press(B), release(B),
+    ]),
+])
+def test_rolling_onto_another_dual_key(policy, expected):
+    tap_hold, output = make_tap_hold(policy)
+    replay(tap_hold, [
+        (0, 0, True), (40, 1, True), (80, 0, False), (120, 1, False),
+    ])
+    assert output == expected
+    assert tap_hold.pending_key == NO_KEY
+
+
+def test_second_dual_key_is_decided_after_the_first():
+    # The second dual key starts pending when the first one resolves
+    tap_hold, output = make_tap_hold(PERMISSIVE_HOLD)
+    replay(tap_hold, [
+        (0, 0, True), (40, 1, True), (80, 0, False),
+        (400, TICK, None), (500, 1, False),
+    ])
+    assert output == [
+        press(A), release(A), press(LSHIFT), release(LSHIFT),
+    ]
+
+
+def test_permissive_buffer_overflow_resolves_hold():
+    tap_hold, output = make_tap_hold(PERMISSIVE_HOLD, buffer_size=2)
+    replay(tap_hold, [
+        (0, 0, True), (10, 2, True), (20, 3, True), (30, 1, True),
+    ])
+    # The third buffered press does not fit: hold, then the replay
+    assert output == [press(LCTRL), press(C), press(D)]
+    assert tap_hold.pending_key == 1
+
+    replay(tap_hold, [
+        (40, 2, False), (50, 3, False), (60, 0, False), (70, 1, False),
+    ])
+    assert output[3:] == [
+        release(C), release(D), release(LCTRL), press(B), release(B),
+    ]
+    assert tap_hold.buffer_len == 0
+
+
+def test_permissive_buffers_key_numbers_past_127():
+    output = []
+    keycodes = bytearray(240)
+    keycodes[200] = C
+    keycodes[239] = A
+    tap_hold = TapHold(
+        keycodes,
+        lambda keycode: output.append(('press', keycode)),
+        lambda keycode: output.append(('release', keycode)),
+    )
+    tap_hold.configure(239, LCTRL, HOLD_TIME, PERMISSIVE_HOLD)
+    replay(tap_hold, [
+        (0, 239, True), (30, 200, True), (60, 200, False), (90, 239, False),
+    ])
+    assert output == [press(LCTRL), press(C), release(C), release(LCTRL)]
+
+
+@pytest.mark.parametrize('start', [TICKS_MASK - 50, TICKS_MASK])
+def test_hold_time_across_the_ticks_wraparound(start):
+    tap_hold, output = make_tap_hold(TAP_PREFERRED)
+    replay(tap_hold, [(0, 0, True), (199, TICK, None)], start)
+    assert output == []
+    replay(tap_hold, [(200, TICK, None), (300, 0, False)], start)
+    assert output == [press(LCTRL), release(LCTRL)]
+
+    output.clear()
+    replay(tap_hold, [(1000, 0, True), (1150, 0, False)], start)
+    assert output == [press(A), release(A)]
+
+
+def test_reset_drops_pending_keys():
+    tap_hold, output = make_tap_hold(PERMISSIVE_HOLD)
+    replay(tap_hold, [(0, 0, True), (10, 2, True)])
+    tap_hold.reset()
+    assert (tap_hold.pending_key, tap_hold.buffer_len) == (NO_KEY, 0)
+    assert not any(tap_hold.hold_keycodes)
+
+
+DUAL_BINDING = {'tap': A, 'hold': LCTRL, 'hold_time': HOLD_TIME}
+
+
+def test_scan_decides_queued_events_on_their_timestamps(firmware):
+    main = firmware(bindings={'cross': DUAL_BINDING})
+    clock = main.hw['supervisor'].clock
+    keyboard = main.hw['adafruit_hid'].devices[0x06]
+    cross = main.KEY_PER_BTN['cross']
+
+    # A tap read late, after the hold time has passed on the clock
+    events = main.keys.events.queue
+    events.append((cross, True, clock.ticks_ms()))
+    events.append((cross, False, clock.ticks_ms() + 150))
+    clock.ms += 500
+    main.scan()
+    main.scan()
+    assert [report[2] for report in keyboard.reports] == [A, 0]
+    assert not any(report[0] for report in keyboard.reports)
+
+    # Held with nothing queued, the clock decides
+    events.append((cross, True, clock.ticks_ms()))
+    main.scan()
+    clock.ms += HOLD_TIME
+    main.scan()
+    assert keyboard.reports[-1][0] == 0x01
+
+
+def test_analog_directions_can_be_dual_keys(firmware):
+    config = {
+        'scan': 'direct',
+        'buttons': ['left', 'right'],
+        'pins': {},
+        'analog': [{
+            'pin': 'A0', 'low': 'left', 'high': 'right',
+            'oversample': 1, 'smoothing': 0,
+        }],
+    }
+    main = firmware(config=config, bindings={'left': DUAL_BINDING})
+    channel = main.analog_channels[0]
+    clock = main.hw['supervisor'].clock
+    keyboard = main.hw['adafruit_hid'].devices[0x06]
+    keyboard.reports.clear()
+
+    channel.value = 0
+    main.scan()
+    clock.ms += 50
+    channel.value = 32768
+    main.scan()
+    assert [report[2] for report in keyboard.reports] == [A, 0]
+
+    channel.value = 0
+    main.scan()
+    clock.ms += HOLD_TIME
+    main.scan()
+    assert keyboard.reports[-1][0] == 0x01
+    channel.value = 32768
+    main.scan()
+    assert keyboard.reports[-1][0] == 0
@@ -5,6 +5,11 @@ import platform
 import argparse
 import string
 import json
+import time
+import select
+import struct
+import ctypes
+import sys
 
 # Pyserial
 import serial
@@ -14,7 +19,27 @@ else:
     import serial.tools.list_ports_linux as list_ports
 
 # App
-from binding_tables import HID_KEY_CODES, BUTTON_NAMES
+from binding_tables import BOARD_DIR, HID_KEY_CODES, BUTTON_NAMES
+
+# Firmware modules without CircuitPython imports are shared with the host
+sys.path.append(BOARD_DIR)
+import binding_store  # NOQA: E402
+from framing import (  # NOQA: E402
+    ACK,
+    encode_frame,
+    FrameDecoder,
+    FRAME_MAX_PAYLOAD,
+)
+from tap_hold import POLICY_NAMES  # NOQA: E402
+
+
+ACK_TIMEOUT = 1
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = os.O_NONBLOCK
+IN_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
 
 
 class BoardException(Exception):
@@ -23,6 +48,71 @@ class BoardException(Exception):
             print(arg)
 
 
+class CommandChannel:
+    def __init__(self, board_serial):
+        self.serial = board_serial
+        self.decoder = FrameDecoder()
+        self.next_seq = 0
+        self.sent_times = {}
+        self.received = {}
+
+    def send(self, command, data=b''):
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) % 256
+        try:
+            frame = encode_frame(seq, command + data)
+        except ValueError as e:
+            raise BoardException(f'Could not send command: {e}.')
+        # Responses that arrived after their request timed out are
+        # dropped before the sequence number is reused
+        self.receive()
+        self.received.pop(seq, None)
+        self.sent_times[seq] = time.perf_counter()
+        self.serial.write(frame)
+        return seq
+
+    def wait(self, seqs, timeout=ACK_TIMEOUT):
+        # Returns {seq: (response, round-trip time in seconds)}
+        pending = set(seqs)
+        responses = {}
+        deadline = time.monotonic() + timeout
+        while True:
+            for seq in pending & self.received.keys():
+                payload, rtt = self.received.pop(seq)
+                pending.remove(seq)
+                if not payload or payload[0] != ACK:
+                    raise BoardException(
+                        'The board rejected a command: ' +
+                        payload[1:].decode(errors='replace')
+                    )
+                responses[seq] = (payload[1:], rtt)
+            if not pending:
+                return responses
+
+            if time.monotonic() > deadline:
+                # Late responses to these are dropped
+                for seq in pending:
+                    self.sent_times.pop(seq, None)
+                raise BoardException(
+                    'The board did not acknowledge ' +
+                    f'{len(pending)} command(s) in {timeout} s.'
+                )
+            if not self.receive():
+                time.sleep(0.001)
+
+    def receive(self):
+        data = self.serial.read(self.serial.in_waiting)
+        for seq, payload in self.decoder.feed(data):
+            if seq in self.sent_times:
+                rtt = time.perf_counter() - self.sent_times.pop(seq)
+                self.received[seq] = (payload, rtt)
+        return data
+
+    def request(self, command, data=b'', timeout=ACK_TIMEOUT):
+        seq = self.send(command, data)
+        return self.wait([seq], timeout)[seq]
+
+
 class CustomHelpFormatter(argparse.HelpFormatter):
     def _format_action_invocation(self, action):
         if not action.option_strings:
@@ -108,23 +198,231 @@ def get_board_path():
         )
 
 
+def format_key(keycode):
+    if not keycode:
+        #  return 'Unbinded'
+        return '--'
+    return get_key_name(keycode).replace('_', ' ')
+
+
 def format_bindings(bindings):
     formatted_bindings = bindings.copy()
     for button, key in bindings.items():
-        if key:
-            key = [
-                key_str
-                for key_str in HID_KEY_CODES.keys()
-                if key == HID_KEY_CODES[key_str]
-            ][0].replace('_', ' ')
+        if isinstance(key, dict):
+            key = '{}, hold {} ({} ms, {})'.format(
+                format_key(key['tap']),
+                format_key(key['hold']),
+                key['hold_time'],
+                key['policy'],
+            )
         else:
-            #  key = 'Unbinded'
-            key = '--'
+            key = format_key(key)
         formatted_bindings[button] = key
 
     return formatted_bindings
 
 
+def get_key_name(keycode):
+    for key_str, code in HID_KEY_CODES.items():
+        if code == keycode:
+            return key_str
+
+
+def is_valid_hold_time(hold_time):
+    return (
+        binding_store.HOLD_TIME_UNIT <= hold_time <=
+        binding_store.HOLD_TIME_MAX
+    )
+
+
+def make_hold_binding(tap, hold, hold_time, policy):
+    # Round trip the hold time so it matches what the board stores
+    hold_time, _ = binding_store.unpack_hold(binding_store.pack_hold(
+        hold_time, POLICY_NAMES.index(policy)
+    ))
+    return {
+        'tap': tap,
+        'hold': hold,
+        'hold_time': hold_time,
+        'policy': policy,
+    }
+
+
+def validate_key(key):
+    if isinstance(key, str):
+        key = key.lower().replace(' ', '_')
+        if key not in HID_KEY_CODES:
+            raise ValueError(f'\'{key}\' does not match any existing key.')
+        return HID_KEY_CODES[key]
+
+    if key is not None and (
+        isinstance(key, bool) or
+        not isinstance(key, int) or
+        key not in HID_KEY_CODES.values()
+    ):
+        raise ValueError(f'\'{key}\' is not a valid key code.')
+
+    return key
+
+
+def validate_hold_binding(binding):
+    unknown = set(binding) - {'tap', 'hold', 'hold_time', 'policy'}
+    if unknown:
+        raise ValueError(
+            f'\'{sorted(unknown)[0]}\' is not a valid hold binding field.'
+        )
+    tap = validate_key(binding.get('tap'))
+    hold = validate_key(binding.get('hold'))
+    if not hold:
+        raise ValueError('Hold bindings need a \'hold\' key.')
+    hold_time = binding.get('hold_time', binding_store.DEFAULT_HOLD_TIME)
+    if (
+        isinstance(hold_time, bool) or
+        not isinstance(hold_time, int) or
+        not is_valid_hold_time(hold_time)
+    ):
+        raise ValueError(
+            f'\'{hold_time}\' is not a valid hold time, it must be ' +
+            f'between {binding_store.HOLD_TIME_UNIT} and ' +
+            f'{binding_store.HOLD_TIME_MAX} ms.'
+        )
+    policy = binding.get('policy', 'hold')
+    if policy not in POLICY_NAMES:
+        raise ValueError(f'\'{policy}\' is not a valid hold policy.')
+
+    return make_hold_binding(tap, hold, hold_time, policy)
+
+
+def validate_bindings(data):
+    if not isinstance(data, dict):
+        raise BoardException(
+            'Bindings must be a JSON object mapping buttons to keys.'
+        )
+
+    errors = []
+    bindings = {
+        button: None
+        for button in BUTTON_NAMES.values()
+    }
+    for button, key in data.items():
+        try:
+            button = validate_button_type(button)
+        except argparse.ArgumentTypeError as e:
+            errors.append(str(e))
+            continue
+
+        try:
+            if isinstance(key, dict):
+                key = validate_hold_binding(key)
+            else:
+                key = validate_key(key)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+
+        bindings[button] = key
+
+    if errors:
+        raise BoardException('Invalid bindings:', *errors)
+
+    return bindings
+
+
+def import_bindings(file_path):
+    try:
+        with open(file_path, 'r') as fp:
+            data = json.load(fp)
+    except OSError as e:
+        raise BoardException(f'Could not read \'{file_path}\': {e.strerror}')
+    except ValueError as e:
+        raise BoardException(f'\'{file_path}\' is not valid JSON: {e}')
+
+    return validate_bindings(data)
+
+
+def export_bindings(file_path, bindings):
+    data = {}
+    for button in BUTTON_NAMES.values():
+        key = bindings[button]
+        if isinstance(key, dict):
+            key = dict(
+                key,
+                tap=get_key_name(key['tap']) if key['tap'] else None,
+                hold=get_key_name(key['hold']),
+            )
+        elif key:
+            key = get_key_name(key)
+        data[button] = key
+    with open(file_path, 'w') as fp:
+        json.dump(data, fp, indent=4, ensure_ascii=False)
+
+
+def diff_bindings(old_bindings, new_bindings):
+    return {
+        button: key
+        for button, key in new_bindings.items()
+        if old_bindings.get(button) != key
+    }
+
+
+def encode_entry(key):
+    # One binding_store entry: tap keycode, hold keycode, hold settings
+    if isinstance(key, dict):
+        return bytes((
+            key['tap'] or 0,
+            key['hold'],
+            binding_store.pack_hold(
+                key['hold_time'], POLICY_NAMES.index(key['policy'])
+            ),
+        ))
+    return bytes((key or 0, 0, 0))
+
+
+def encode_bindings(bindings):
+    table = bytearray()
+    for button in BUTTON_NAMES.values():
+        table += encode_entry(bindings.get(button))
+
+    return binding_store.encode(table)
+
+
+def encode_changes(changes):
+    # 'set' payloads, each a list of button indexes followed by their
+    # entry, split to fit in frames
+    entries = [
+        bytes((button_n - 1,)) + encode_entry(changes[button])
+        for button_n, button in BUTTON_NAMES.items()
+        if button in changes
+    ]
+    per_frame = (FRAME_MAX_PAYLOAD - len(b'set ')) // len(entries[0])
+    return [
+        b''.join(entries[i:i + per_frame])
+        for i in range(0, len(entries), per_frame)
+    ]
+
+
+def decode_bindings(data):
+    table = bytearray(len(BUTTON_NAMES) * binding_store.ENTRY_SIZE)
+    try:
+        binding_store.decode_into(data, table)
+    except ValueError as e:
+        raise BoardException(f'Invalid board binding table: {e}.')
+
+    bindings = {}
+    for i, button in enumerate(BUTTON_NAMES.values()):
+        entry = i * binding_store.ENTRY_SIZE
+        tap, hold, setting = table[entry:entry + binding_store.ENTRY_SIZE]
+        if hold:
+            hold_time, policy = binding_store.unpack_hold(setting)
+            bindings[button] = make_hold_binding(
+                tap or None, hold, hold_time, POLICY_NAMES[policy]
+            )
+        else:
+            bindings[button] = tap or None
+
+    return bindings
+
+
 def get_bindings(config_file_path):
     if os.path.exists(config_file_path):
         with open(config_file_path, 'r') as fp:
@@ -147,6 +445,59 @@ def get_bindings(config_file_path):
     return bindings
 
 
+def _read_inotify_names(fd):
+    names = set()
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return names
+    offset = 0
+    while offset < len(data):
+        _, _, _, name_len = IN_EVENT_HEADER.unpack_from(data, offset)
+        offset += IN_EVENT_HEADER.size
+        names.add(os.fsdecode(data[offset:offset + name_len].rstrip(b'\0')))
+        offset += name_len
+
+    return names
+
+
+def watch_file(file_path, on_change, debounce=0.1):
+    if platform.system() != 'Linux':
+        raise BoardException('Watch mode is only supported on Linux.')
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK)
+    if fd < 0:
+        raise BoardException(
+            'Could not start inotify: ' + os.strerror(ctypes.get_errno())
+        )
+
+    # Editors often save by renaming a temporary file over the original,
+    # so the directory is watched instead of the file itself
+    dir_path, file_name = os.path.split(os.path.abspath(file_path))
+    try:
+        wd = libc.inotify_add_watch(
+            fd, os.fsencode(dir_path), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            raise BoardException(
+                f'Could not watch \'{dir_path}\': ' +
+                os.strerror(ctypes.get_errno())
+            )
+
+        while True:
+            select.select([fd], [], [])
+            if file_name not in _read_inotify_names(fd):
+                continue
+            change_time = time.perf_counter()
+            # Wait for the save burst to settle
+            while select.select([fd], [], [], debounce)[0]:
+                _read_inotify_names(fd)
+            on_change(change_time)
+    finally:
+        os.close(fd)
+
+
 def validate_button_type(button):
     msg = f'\'{button}\' does not match any existing button.'
     try:
@@ -166,23 +517,39 @@ def validate_button_type(button):
 
 
 class ValidateBindingAction(argparse.Action):
+    # The button is checked with validate_button_type() after parsing,
+    # once the board's config.json is loaded
     def __call__(self, parser, namespace, values, option_string=None):
-        try:
-            button = validate_button_type(values[0])
-        except argparse.ArgumentTypeError as e:
-            raise argparse.ArgumentError(self, e)
-
-        key = values[1].lower().replace(' ', '_')
-
-        if key not in HID_KEY_CODES:
-            msg = f'\'{key}\' does not match any existing key.'
-            raise argparse.ArgumentError(self, msg)
+        button = values[0]
+        keys = []
+        for key in values[1:]:
+            key = key.lower().replace(' ', '_')
+            if key not in HID_KEY_CODES:
+                msg = f'\'{key}\' does not match any existing key.'
+                raise argparse.ArgumentError(self, msg)
+            keys.append(key)
 
         list_ = getattr(namespace, self.dest) or []
-        list_.append((button, key))
+        list_.append((button, *keys))
         setattr(namespace, self.dest, list_)
 
 
+def validate_hold_time_type(hold_time):
+    msg = (
+        f'Hold time must be between {binding_store.HOLD_TIME_UNIT} and ' +
+        f'{binding_store.HOLD_TIME_MAX} ms.'
+    )
+    try:
+        hold_time = int(hold_time)
+    except ValueError:
+        raise argparse.ArgumentTypeError(msg)
+
+    if not is_valid_hold_time(hold_time):
+        raise argparse.ArgumentTypeError(msg)
+
+    return hold_time
+
+
 def validate_path_type(path):
     if platform.system() == 'Windows':
         if not path.endswith('\\'):
@@ -198,6 +565,14 @@ def validate_path_type(path):
     return path
 
 
+def validate_file_type(path):
+    if not os.path.isfile(path):
+        msg = 'Specified file does not exists.'
+        raise argparse.ArgumentTypeError(msg)
+
+    return path
+
+
 def validate_port_type(port):
     OS = platform.system()
     if OS == 'Linux':